@@ -0,0 +1,85 @@
+import argparse, sys, timeit, unicodedata, random
+from main import IOUtilities, ANSI_REGEX
+
+parser = argparse.ArgumentParser(
+    prog=sys.argv[0],
+    description="A micro-benchmark of the display width engine against the previous per-code-point implementation",
+)
+
+parser.add_argument("--names", type=int, default=2000)
+parser.add_argument("--repeat", type=int, default=5)
+args = parser.parse_args()
+
+
+# the implementation before the width engine, kept here for comparison
+def legacy_term_length(string: str) -> int:
+    string = ANSI_REGEX.sub("", string).replace("\n", "")
+    length = 0
+    for char in string:
+        length += 2 if unicodedata.east_asian_width(char) in ["W", "F"] else 1
+    return length
+
+
+def legacy_process_name(name: str) -> "list[str]":
+    length = legacy_term_length(name)
+    if length < 60:
+        cur_len, idx = 0, 0
+        cur = ""
+        while cur_len < length / 2:
+            cur += name[idx]
+            cur_len += legacy_term_length(name[idx])
+            idx += 1
+        return [cur, name[idx:]]
+    lines = []
+    cur = ""
+    cur_len = 0
+    idx = 0
+    while idx < len(name):
+        while cur_len < 30 and idx < len(name):
+            cur += name[idx]
+            cur_len += legacy_term_length(name[idx])
+            idx += 1
+        lines.append(cur)
+        cur = ""
+        cur_len = 0
+    return lines
+
+
+CORPORA = {
+    "cjk": ["夜に駆ける", "사랑해", "群青", "Lemon", "café", "Live", "アイドル"],
+    "emoji": ["夜に駆ける", "사랑해", "Lemon", "❤️", "👨‍👩‍👧", "🇯🇵", "👍🏽", "Live"],
+}
+rng = random.Random(0)
+
+# measure the uncached functions, otherwise only the first pass does any work
+term_length = IOUtilities.term_length.__wrapped__
+process_name = IOUtilities.process_name.__wrapped__
+
+for corpus, words in CORPORA.items():
+    names = [
+        " ".join(rng.choice(words) for _ in range(rng.randint(2, 12)))
+        + f" [{rng.randbytes(8).hex()[:11]}]"
+        for _ in range(args.names)
+    ]
+    # fills the lookup tables outside of the timing
+    for name in names:
+        term_length(name)
+        process_name(name)
+
+    for label, legacy, current in [
+        ("term_length", legacy_term_length, term_length),
+        ("process_name", legacy_process_name, process_name),
+    ]:
+        before = min(
+            timeit.repeat(
+                lambda: [legacy(n) for n in names], number=1, repeat=args.repeat
+            )
+        )
+        after = min(
+            timeit.repeat(
+                lambda: [current(n) for n in names], number=1, repeat=args.repeat
+            )
+        )
+        print(
+            f"{corpus} {label}: legacy {before * 1e6 / len(names):.2f}us/name, engine {after * 1e6 / len(names):.2f}us/name ({before / after:.2f}x)"
+        )
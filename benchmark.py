@@ -0,0 +1,240 @@
+import argparse, io, json, os, random, sys, tempfile, time, timeit, types, contextlib, platform
+
+# the benchmark runs headless, so the audio and discord dependencies are replaced
+# before main is imported
+mixer_stub = types.ModuleType("pygame.mixer")
+
+
+class StubMusic:
+    def get_pos(self) -> int:
+        return 83_000
+
+    def get_busy(self) -> bool:
+        return True
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+mixer_stub.music = StubMusic()
+mixer_stub.init = lambda *args, **kwargs: None
+pygame_stub = types.ModuleType("pygame")
+pygame_stub.mixer = mixer_stub
+presence_stub = types.ModuleType("pypresence")
+presence_stub.Presence = None
+presence_stub.PipeClosed = Exception
+sys.modules.update(
+    {"pygame": pygame_stub, "pygame.mixer": mixer_stub, "pypresence": presence_stub}
+)
+
+# keeps import-time warnings out of the json on stdout
+with contextlib.redirect_stdout(sys.stderr):
+    from main import (
+        IOUtilities,
+        LibraryIndex,
+        MusicPlayer,
+        SearchIndex,
+        TerminalRenderer,
+        WeightedSampler,
+    )
+
+parser = argparse.ArgumentParser(
+    prog=sys.argv[0],
+    description="Benchmarks the player's hot paths on synthetic libraries",
+)
+
+parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10_000, 100_000])
+parser.add_argument("--prefix-keys", type=int, default=1000)
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--output", help="write the json results here instead of stdout")
+args = parser.parse_args()
+
+WORDS = [
+    "夜に駆ける",
+    "사랑해",
+    "群青",
+    "Lemon",
+    "❤️",
+    "👨‍👩‍👧",
+    "🇯🇵",
+    "café",
+    "Live",
+    "Remix",
+    "Official Video",
+    "feat.",
+]
+ID_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_"
+
+
+def generate_names(rng: random.Random, count: int) -> "list[str]":
+    names = set()
+    while len(names) < count:
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 8)))
+        video_id = "".join(rng.choice(ID_CHARS) for _ in range(11))
+        names.add(f"{title} [{video_id}].mp3")
+    return sorted(names)
+
+
+def build_library(directory: str, names: "list[str]") -> LibraryIndex:
+    # rows are written straight into the index, so no files or length probes are needed
+    library = LibraryIndex(os.path.join(directory, f"index-{len(names)}.db"))
+    library.connection.executemany(
+        "INSERT INTO tracks (path, mtime, size, length, youtube_id, display_name) VALUES (?, 0, 0, ?, ?, ?)",
+        [(name, 180.0, *LibraryIndex.describe(name)) for name in names],
+    )
+    library.connection.commit()
+    library._load()
+    return library
+
+
+def build_weights(directory: str, rng: random.Random, names: "list[str]") -> str:
+    weights = {}
+    for name in rng.sample(names, min(args.prefix_keys, len(names))):
+        # a mix of exact names and prefixes of varying length
+        key = name if rng.random() < 0.3 else name[: rng.randint(1, len(name) // 2)]
+        weights[key] = rng.randint(1, 20)
+    path = os.path.join(directory, f"weights-{len(names)}.json")
+    with open(path, "w", encoding="utf8") as file:
+        json.dump(weights, file, ensure_ascii=False)
+    return path
+
+
+def measure(target, number: int) -> "dict[str, float]":
+    times = timeit.repeat(target, number=number, repeat=args.repeat)
+    per_call = [total / number for total in times]
+    return {
+        "best_us": min(per_call) * 1e6,
+        "mean_us": sum(per_call) / len(per_call) * 1e6,
+        "calls": number,
+    }
+
+
+def make_player(library: LibraryIndex, weights_file: str) -> MusicPlayer:
+    player = MusicPlayer(
+        False,
+        None,
+        weights_file=weights_file,
+        metadata_cache=None,
+        enable_share=False,
+        library=library,
+    )
+    player.queue_content = ""
+    player.auto = ""
+    player.is_queueing = False
+    player.volume = 1.0
+    player.wakeup_rate = 0.0
+    player.playing = True
+    player.name = IOUtilities.normalize(library.tracks[library.files()[0]].display_name)
+    player.youtube_id = None
+    player.length = 180.0
+    player.renderer = TerminalRenderer()
+    player.renderer.columns = 120
+    now = time.monotonic()
+    player.next_render = player.next_presence = player.next_share = now + 3600
+    player.wakeups, player.wakeup_window = 0, now
+    return player
+
+
+def run_size(directory: str, rng: random.Random, size: int) -> "dict[str, dict]":
+    names = generate_names(rng, size)
+    library = build_library(directory, names)
+    weights_file = build_weights(directory, rng, names)
+    sample = [name[: -len(".mp3")] for name in rng.sample(names, min(size, 500))]
+    results = {}
+
+    number = max(1, 100_000 // size)
+    results["generate_weights"] = measure(
+        lambda: list(IOUtilities.generate_weights(weights_file, library.files())),
+        max(1, number // 10),
+    )
+    sampler = WeightedSampler(weights_file, library)
+    results["sampler_compile"] = measure(sampler.compile, max(1, number // 10))
+    sampler.refresh()
+    results["sampler_draw"] = measure(sampler.draw, 10_000)
+
+    term_length = IOUtilities.term_length.__wrapped__
+    process_name = IOUtilities.process_name.__wrapped__
+    results["term_length"] = measure(lambda: [term_length(n) for n in sample], 10)
+    results["term_length"]["per_name_us"] = results["term_length"]["best_us"] / len(
+        sample
+    )
+    results["process_name"] = measure(lambda: [process_name(n) for n in sample], 10)
+    results["process_name"]["per_name_us"] = results["process_name"]["best_us"] / len(
+        sample
+    )
+
+    player = make_player(library, weights_file)
+    prefixes = [name[: rng.randint(1, 6)] for name in sample]
+
+    def autocomplete():
+        for prefix in prefixes:
+            player.auto, player.queue_content = "", prefix
+            player.autocomplete()
+            player.autocomplete()
+
+    player.search = SearchIndex(library)
+    player.search.sync()
+    results["autocomplete"] = measure(autocomplete, 1)
+    results["autocomplete"]["per_query_us"] = results["autocomplete"]["best_us"] / (
+        2 * len(prefixes)
+    )
+    queries = [name.split(" [")[0][-4:] for name in sample[:20]]
+    results["fuzzy_search"] = measure(
+        lambda: [
+            (setattr(player.search, "_last", None), player.search.search(q))
+            for q in queries
+        ],
+        1,
+    )
+    results["fuzzy_search"]["per_query_us"] = results["fuzzy_search"]["best_us"] / len(
+        queries
+    )
+
+    results["render_progress_bar"] = measure(player.render_progress_bar, 1000)
+    lines = [
+        f"Now playing {player.name}",
+        player.render_progress_bar(),
+        "controls: [s]kip, [r]eload presence, [p]ause, volume [u]p, volume [d]own, [q]ueue mode",
+        "volume: 1.00",
+        "",
+    ]
+    results["calculate_lines_written"] = measure(
+        lambda: sum(player.renderer.rows(line) for line in lines), 1000
+    )
+
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        # an idle wakeup, then one that renders a frame
+        results["play_loop_idle_tick"] = measure(lambda: player.tick(""), 10_000)
+
+        def render_tick():
+            player.next_render = 0
+            player.tick("")
+
+        results["play_loop_render_tick"] = measure(render_tick, 1000)
+    # the mixer stub reports a fixed position, so after the first frame this is
+    # the cost of a redraw where only the status line changes
+    results["play_loop_render_tick"]["bytes_per_frame"] = len(output.getvalue()) / (
+        args.repeat * 1000
+    )
+    library.close()
+    return results
+
+
+rng = random.Random(args.seed)
+report = {
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "time": time.time(),
+    "results": {},
+}
+with tempfile.TemporaryDirectory() as directory:
+    for size in args.sizes:
+        report["results"][str(size)] = run_size(directory, rng, size)
+
+if args.output:
+    with open(args.output, "w", encoding="utf8") as file:
+        json.dump(report, file, indent=2)
+else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -1,5 +1,5 @@
 import argparse, sys
-from main import IOUtilities
+from main import LibraryIndex, WeightedSampler, LIBRARY_INDEX_FILE, METRICS
 
 parser = argparse.ArgumentParser(
     prog=sys.argv[0],
@@ -7,13 +7,73 @@ parser = argparse.ArgumentParser(
 )
 
 parser.add_argument("--weights", required=False)
+parser.add_argument("--index", default=LIBRARY_INDEX_FILE)
+parser.add_argument("--library", action="append")
+parser.add_argument("--scan-workers", type=int, default=8)
+parser.add_argument(
+    "--schedule",
+    type=int,
+    metavar="TRACKS",
+    help="write a schedule of this many tracks for main.py --schedule instead (needs numpy)",
+)
+parser.add_argument("--output", help="where to write the schedule, default stdout")
+parser.add_argument(
+    "--simulate",
+    type=float,
+    metavar="HOURS",
+    help="simulate play counts over this many hours of listening instead (needs numpy)",
+)
+parser.add_argument("--runs", type=int, default=1000)
+parser.add_argument(
+    "--min-distance",
+    type=int,
+    default=0,
+    help="at least this many other tracks between repeats of a track",
+)
+parser.add_argument("--seed", type=int)
 args = parser.parse_args()
 
-keys, weights = IOUtilities.generate_weights(args.weights)
-total = sum(weights)
-combined = []
-for item in range(len(keys)):
-    combined.append((keys[item], round(weights[item] * 100 / total, 2)))
+library = LibraryIndex(args.index, args.library, args.scan_workers)
+# only simulating needs the track lengths, so the rest skip probing new files
+library.scan(force=True, probe=args.simulate is not None)
+print(library.throughput(), file=sys.stderr)
+sampler = WeightedSampler(args.weights, library)
+combined = [
+    (key, round(probability * 100, 2))
+    for key, probability in sampler.probabilities().items()
+]
+for warning in METRICS.warnings:
+    print(f"warning: {warning}", file=sys.stderr)
+
+try:
+    if args.schedule is not None:
+        schedule = sampler.schedule(args.schedule, args.min_distance, args.seed)
+        output = (
+            sys.stdout
+            if args.output is None
+            else open(args.output, "w", encoding="utf8")
+        )
+        with output:
+            print(
+                f"# {len(schedule)} tracks from {args.weights or 'equal weights'}",
+                file=output,
+            )
+            for track in schedule:
+                print(track, file=output)
+        sys.exit(0)
+    if args.simulate is not None:
+        plays = sampler.simulate(args.simulate, args.runs, args.min_distance, args.seed)
+        total = sum(mean for mean, _, _ in plays.values())
+        expected = dict(combined)
+        for key, (mean, low, high) in sorted(plays.items(), key=lambda k: k[1][0]):
+            print(
+                f"{key}: {expected[key]}% weighted, {round(mean / total * 100, 2)}% played, {mean:.1f} plays ({low:.0f}-{high:.0f})"
+            )
+        sys.exit(0)
+except ImportError:
+    sys.exit("--schedule and --simulate need numpy, pip install numpy")
+except ValueError as e:
+    sys.exit(str(e))
 
 for item in sorted(combined, key=lambda k: k[1]):
     print(f"{item[0]}: {item[1]}%")
@@ -0,0 +1,44 @@
+import argparse, json, math, socket, sys
+from main import CONTROL_SOCKET_FILE
+
+parser = argparse.ArgumentParser(
+    prog=sys.argv[0],
+    description="Controls an Inflo player started with --daemon",
+)
+
+parser.add_argument("--socket", default=CONTROL_SOCKET_FILE)
+commands = parser.add_subparsers(dest="command", required=True)
+for command in ["skip", "pause", "resume", "toggle", "reload", "status", "metrics"]:
+    commands.add_parser(command)
+volume = commands.add_parser("volume", help="e.g. 0.5, or +0.1/-0.1 to adjust")
+volume.add_argument("value")
+queue = commands.add_parser("queue", help="queues the best match for a song name")
+queue.add_argument("song", nargs="+")
+args = parser.parse_args()
+
+request = {"command": args.command}
+if args.command == "volume":
+    try:
+        value = float(args.value)
+    except ValueError:
+        value = math.nan
+    if not math.isfinite(value):
+        volume.error(f"volume must be a number, not {args.value!r}")
+    # a sign makes it relative to the current volume
+    key = "delta" if args.value[0] in "+-" else "value"
+    request[key] = value
+elif args.command == "queue":
+    request["song"] = " ".join(args.song)
+
+with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+    try:
+        connection.connect(args.socket)
+    except OSError as e:
+        sys.exit(f"can't connect to the player at {args.socket}: {e}")
+    with connection.makefile("rwb") as stream:
+        stream.write(json.dumps(request).encode() + b"\n")
+        stream.flush()
+        response = json.loads(stream.readline())
+
+print(json.dumps(response, indent=2, ensure_ascii=False))
+sys.exit(0 if response.get("ok") else 1)
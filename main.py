@@ -1,304 +1,2952 @@
-import functools
-import os, time, pypresence, random, sys, subprocess, threading, json, argparse, atexit, re, requests, requests_cache, math, unicodedata, contextlib, bisect
-from typing import TYPE_CHECKING, Any
+import time
+
+STARTED = time.perf_counter()
+
+import functools, importlib, struct
+import os, random, sys, subprocess, threading, json, argparse, atexit, re, math, unicodedata, contextlib, bisect, sqlite3, selectors, shutil, signal, itertools, socket, collections, weakref
+from typing import TYPE_CHECKING, Any, Iterator, NamedTuple
 
 try:
     import tty, termios
 
-    UNIX_TTY = True
-except Exception:
-    UNIX_TTY = False
-    try:
-        import msvcrt
+    UNIX_TTY = True
+except Exception:
+    UNIX_TTY = False
+    try:
+        import msvcrt
+
+        MSVCRT = True
+    except ImportError:
+        MSVCRT = False
+
+
+class StartupTimings:
+    # milestones since main was imported, plus how long each lazy import took
+    marks: "dict[str, float]"
+    imports: "dict[str, float]"
+    notes: "dict[str, str]"
+
+    def __init__(self):
+        self.marks = {}
+        self.imports = {}
+        self.notes = {}
+
+    def mark(self, label: str) -> None:
+        # only the first time counts
+        self.marks.setdefault(label, time.perf_counter() - STARTED)
+
+    def note(self, label: str, text: str) -> None:
+        self.notes.setdefault(label, text)
+
+    def report(self) -> str:
+        lines = ["startup timings:"]
+        for label, elapsed in sorted(self.marks.items(), key=lambda item: item[1]):
+            lines.append(f"  {elapsed * 1000:9.1f} ms  {label}")
+        for name, duration in sorted(self.imports.items(), key=lambda item: -item[1]):
+            lines.append(f"  import {name}: {duration * 1000:.1f} ms")
+        for text in self.notes.values():
+            lines.append(f"  {text}")
+        return "\n".join(lines)
+
+
+TIMINGS = StartupTimings()
+
+
+class Histogram:
+    # latencies in power-of-two buckets from 10us up, so recording stays cheap and
+    # percentiles are accurate to a factor of two
+    BOUNDS = [0.00001 * 2**i for i in range(20)]
+    counts: "list[int]"
+    count: "int"
+    total: "float"
+    peak: "float"
+    lock: "threading.Lock"
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.peak = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self.lock:
+            self.counts[bisect.bisect_left(Histogram.BOUNDS, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.peak = max(self.peak, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        # the upper bound of the bucket the percentile falls in
+        remaining = fraction * self.count
+        for idx, count in enumerate(self.counts):
+            remaining -= count
+            if remaining <= 0 and idx < len(Histogram.BOUNDS):
+                return min(Histogram.BOUNDS[idx], self.peak)
+        return self.peak
+
+    def summary(self) -> "dict[str, float]":
+        return {
+            "count": self.count,
+            "mean_ms": self.total / max(self.count, 1) * 1000,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": self.peak * 1000,
+        }
+
+
+class Metrics:
+    # runtime counters for the status line, --metrics-log and the control socket:
+    # latency histograms, cache hit rates and the threads seen so far. threads are
+    # sampled whenever the play loop wakes up, so very short-lived ones can be missed.
+    # warnings are counted here rather than printed, since most come from background
+    # threads and printing would tear the frame the renderer is drawing
+    histograms: "dict[str, Histogram]"
+    caches: "dict[str, Any]"
+    threads: "weakref.WeakSet[threading.Thread]"
+    threads_seen: "int"
+    warnings: "dict[str, int]"
+
+    def __init__(self):
+        self.histograms = {}
+        self.caches = {}
+        self.threads = weakref.WeakSet()
+        self.threads_seen = 0
+        self.warnings = {}
+
+    def histogram(self, name: str) -> "Histogram":
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def record(self, name: str, seconds: float) -> None:
+        self.histogram(name).record(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name: str) -> "Iterator[None]":
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def warn(self, message: str) -> None:
+        # re-inserted, so the latest warning is always last
+        count = self.warnings.pop(message, 0)
+        self.warnings[message] = count + 1
+
+    def warning(self) -> "str | None":
+        warnings = list(self.warnings)
+        if not warnings:
+            return None
+        more = f" (+{len(warnings) - 1} more)" if len(warnings) > 1 else ""
+        return f"warning: {warnings[-1]}{more}"
+
+    def register_cache(self, name: str, stats) -> None:
+        # stats returns a dict with at least hits and misses
+        self.caches[name] = stats
+
+    def sample_threads(self) -> None:
+        for thread in threading.enumerate():
+            if thread not in self.threads:
+                self.threads.add(thread)
+                self.threads_seen += 1
+
+    def snapshot(self) -> "dict[str, Any]":
+        self.sample_threads()
+        caches = {}
+        for name, stats in self.caches.items():
+            counts = stats()
+            caches[name] = {
+                **counts,
+                "hit_rate": counts["hits"] / max(counts["hits"] + counts["misses"], 1),
+            }
+        return {
+            "time": time.time(),
+            "latency": {
+                name: histogram.summary() for name, histogram in self.histograms.items()
+            },
+            "caches": caches,
+            "threads": {
+                "active": threading.active_count(),
+                "seen": self.threads_seen,
+            },
+            "warnings": dict(self.warnings),
+        }
+
+    def status(self) -> "list[str]":
+        # two lines for the ui: latencies, then cache hit rates and threads
+        snapshot = self.snapshot()
+        latency = ", ".join(
+            f"{name} p50 {summary['p50_ms']:.2g}ms p99 {summary['p99_ms']:.2g}ms"
+            for name, summary in snapshot["latency"].items()
+        )
+        caches = ", ".join(
+            f"{name} {stats['hit_rate'] * 100:.0f}%"
+            for name, stats in snapshot["caches"].items()
+        )
+        threads = snapshot["threads"]
+        return [
+            f"latency: {latency or 'none yet'}",
+            f"cache hits: {caches}, threads: {threads['active']} active, {threads['seen']} seen",
+        ]
+
+
+METRICS = Metrics()
+
+
+class BoundedCache:
+    # a thread-safe memo with an entry limit, an optional byte budget and an optional
+    # ttl. the least recently used entries are evicted first, expired ones when they
+    # are next looked up. caches register themselves by name, so their limits can be
+    # changed from the command line, and with METRICS for their statistics
+    MISSING = object()
+    instances: "dict[str, BoundedCache]" = {}
+    limits: "dict[str, dict[str, float]]" = {}
+    name: "str"
+    max_entries: "int"
+    max_bytes: "int | None"
+    ttl: "float | None"
+    entries: "collections.OrderedDict[Any, tuple[Any, float, int]]"
+    bytes: "int"
+    hits: "int"
+    misses: "int"
+    evictions: "int"
+    expirations: "int"
+    lock: "threading.Lock"
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = 4096,
+        max_bytes: "int | None" = None,
+        ttl: "float | None" = None,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self.lock = threading.Lock()
+        BoundedCache.instances[name] = self
+        METRICS.register_cache(name, self.stats)
+        self.configure(**BoundedCache.limits.get(name, {}))
+
+    @staticmethod
+    def weigh(key: Any, value: Any) -> int:
+        # shallow, plus one level of the lists and tuples most of the values are
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        for item in (key, value):
+            if isinstance(item, (list, tuple)):
+                size += sum(sys.getsizeof(element) for element in item)
+        return size
+
+    @staticmethod
+    def file_key(path: str) -> "tuple[str, int | None, int | None]":
+        # a file's path and version, so a file that changed misses
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path, None, None
+        return path, stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def memoize(
+        name: str,
+        max_entries: int = 4096,
+        max_bytes: "int | None" = None,
+        ttl: "float | None" = None,
+        key=None,
+    ):
+        # key maps the arguments to the cache key, by default the arguments themselves
+        def decorate(function):
+            cache = BoundedCache(name, max_entries, max_bytes, ttl)
+
+            entries = cache.entries
+
+            @functools.wraps(function)
+            def memoized(*args):
+                cache_key = args if key is None else key(*args)
+                # the common case of a fresh hit, inlined from get since these
+                # wrap functions called many times per frame
+                entry = entries.get(cache_key)
+                if entry is not None and cache.ttl is None:
+                    try:
+                        entries.move_to_end(cache_key)
+                    except KeyError:
+                        pass
+                    cache.hits += 1
+                    return entry[0]
+                value = cache.get(cache_key, BoundedCache.MISSING)
+                if value is BoundedCache.MISSING:
+                    value = function(*args)
+                    cache.put(cache_key, value)
+                return value
+
+            memoized.cache = cache
+            return memoized
+
+        return decorate
+
+    @staticmethod
+    def configure_all(limits: "dict[str, dict[str, float]]") -> None:
+        # applies to the caches that exist already and the ones created later
+        BoundedCache.limits = limits
+        for name, settings in limits.items():
+            cache = BoundedCache.instances.get(name)
+            if cache is not None:
+                cache.configure(**settings)
+
+    def configure(
+        self,
+        max_entries: "int | None" = None,
+        max_bytes: "int | None" = None,
+        ttl: "float | None" = None,
+    ) -> None:
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if ttl is not None:
+                self.ttl = ttl
+            self._evict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        # hits don't take the lock: the lookup and the move are atomic on their own,
+        # and an entry evicted in between is still a valid result
+        entry = self.entries.get(key)
+        if entry is None or (
+            self.ttl is not None and time.monotonic() - entry[1] > self.ttl
+        ):
+            with self.lock:
+                if entry is not None and self.entries.get(key) is entry:
+                    self._remove(key)
+                    self.expirations += 1
+                self.misses += 1
+            return default
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            pass
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Any, value: Any) -> None:
+        size = BoundedCache.weigh(key, value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.monotonic(), size)
+            self.bytes += size
+            self._evict()
+
+    def _remove(self, key: Any) -> None:
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+    def _evict(self) -> None:
+        while len(self.entries) > self.max_entries or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> "dict[str, int]":
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+        }
+
+
+class LazyModule:
+    # stands in for a heavy dependency and imports it on first attribute access
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            started = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            TIMINGS.imports[self._name] = time.perf_counter() - started
+        return getattr(self._module, attr)
+
+
+os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "hide"
+mixer = LazyModule("pygame.mixer")
+pypresence = LazyModule("pypresence")
+requests = LazyModule("requests")
+futures = LazyModule("concurrent.futures")
+# optional, only needed to plan schedules (see generate_weights.py)
+numpy = LazyModule("numpy")
+
+YOUTUBE_DL_ID_REGEX = re.compile(r"\[[a-zA-Z0-9\-_]{11}]")
+ANSI_REGEX = re.compile("\x1b\\[\\d+?m")
+INFLO_SHARE_URL = "https://inflo-share-server.onrender.com/"
+LIBRARY_INDEX_FILE = ".inflo_index.db"
+PRESENCE_REFRESH_INTERVAL = 15
+NETWORK_TIMEOUT = 5
+DISCORD_CLIENT_ID = "1033827079994753064"
+INFLO_API_URL = "https://inflo-api.thefightagainstmalware.workers.dev/"
+METADATA_CACHE_FILE = ".inflo_metadata.db"
+CONTROL_SOCKET_FILE = ".inflo.sock"
+HISTORY_FILE = ".inflo_history.bin"
+
+
+class IOUtilities:
+    @staticmethod
+    def generate_weights(weights_file: str, files: "list[str] | None" = None):
+        if files is None:
+            files = list(LibraryIndex.walk(["."])[0])
+        if weights_file is None:
+            return [files, None]
+        data: "dict[str, str]" = json.load(open(weights_file, encoding="utf8"))
+        # sort data by key length, shortest first. this allows longer completions to override shorter ones
+        data = {k: v for k, v in sorted(data.items(), key=lambda item: len(item[0]))}
+
+        # keys are paths or prefixes of file names. prefixes are resolved by bisecting
+        # the sorted names instead of scanning every file per key
+        files = sorted(files)
+        file_set = set(files)
+        names = [os.path.basename(file) for file in files]
+        if names != files:
+            files = sorted(files, key=os.path.basename)
+            names = [os.path.basename(file) for file in files]
+        weights = {}
+        for key in data:
+            if not isinstance(data[key], (int, float)):
+                continue
+            if key in file_set:
+                weights[key] = data[key]
+            else:
+                lo = bisect.bisect_left(names, key)
+                hi = bisect.bisect_left(names, key + "\U0010ffff", lo)
+                if lo == hi:
+                    METRICS.warn(f"no such key {key} in {weights_file}")
+                for completion in files[lo:hi]:
+                    weights[completion] = data[key]
+        for file in files:
+            if file not in weights:
+                weights[file] = 1
+        return zip(*weights.items())
+
+    @staticmethod
+    def setraw():
+        if UNIX_TTY:
+            tty.setraw(sys.stdin.fileno())
+            os.set_blocking(sys.stdin.fileno(), False)
+
+    @staticmethod
+    def unsetraw(normal_tty_settings):
+        if UNIX_TTY:
+            termios.tcsetattr(
+                sys.stdin.fileno(), termios.TCSADRAIN, normal_tty_settings
+            )
+
+    @staticmethod
+    @BoundedCache.memoize("term_length")
+    def term_length(string: str) -> int:
+        if "\x1b" in string:
+            string = ANSI_REGEX.sub("", string)
+        return WidthEngine.width(string.replace("\n", ""))
+
+    @staticmethod
+    @BoundedCache.memoize("process_name")
+    def process_name(name: str) -> "list[str]":
+        # splits on grapheme cluster boundaries instead of code points
+        length = IOUtilities.term_length(name)
+        if length < 60:
+            lines = WidthEngine.wrap(name, length / 2)
+            return [lines[0], "".join(lines[1:])] if lines else ["", ""]
+        return WidthEngine.wrap(name, 30)
+
+    @staticmethod
+    @BoundedCache.memoize("normalize")
+    def normalize(text: str) -> str:
+        return unicodedata.normalize("NFC", text)
+
+    @staticmethod
+    def read_keys() -> "str | None":
+        # everything currently available on stdin, without blocking. None means EOF
+        if UNIX_TTY:
+            try:
+                data = os.read(sys.stdin.fileno(), 1024)
+            except (BlockingIOError, InterruptedError):
+                return ""
+            if data == b"":
+                return None
+            keys = data.decode("utf8", errors="ignore")
+        elif MSVCRT:
+            keys = ""
+            while msvcrt.kbhit():
+                keys += msvcrt.getwch()
+        else:
+            return ""
+        if "\x03" in keys:
+            raise KeyboardInterrupt()
+        return keys
+
+    @staticmethod
+    @BoundedCache.memoize("mutagen_mp3", max_entries=1)
+    def mutagen_mp3():
+        try:
+            started = time.perf_counter()
+            from mutagen.mp3 import MP3
+
+            TIMINGS.imports["mutagen.mp3"] = time.perf_counter() - started
+            return MP3
+        except ImportError:
+            METRICS.warn("no mutagen, falling back to ffprobe for mp3 lengths")
+            return None
+
+    @staticmethod
+    @BoundedCache.memoize("get_length", max_entries=8192, key=BoundedCache.file_key)
+    def get_length(music: str) -> float:
+        with METRICS.timed("get_length"):
+            try:
+                return IOUtilities.mutagen_mp3()(music).info.length
+            except Exception:
+                try:
+                    return float(
+                        subprocess.check_output(
+                            [
+                                "ffprobe",
+                                "-i",
+                                music,
+                                "-show_entries",
+                                "format=duration",
+                                "-v",
+                                "quiet",
+                                "-of",
+                                'csv="p=0"',
+                            ]
+                        )
+                    )
+                except Exception:
+                    # raised rather than returned, so the failure isn't memoized
+                    METRICS.warn("ffprobe failed, some lengths are unknown")
+                    raise ValueError(f"couldn't probe the length of {music}")
+
+
+# grapheme clusters matched over a string of WidthEngine classes, one per code point:
+# a regional indicator pair, a hangul syllable sequence or any single code point,
+# followed by extend characters and zwj-joined code points
+GRAPHEME_CLASS_REGEX = re.compile(
+    "\x04|(?:\x03\x03|\x05*(?:[\x06\x08]\x06*\x07*|\x09\x07*)|\x05+|\x07+|[^\x04])(?:\x01|\x02[^\x04]?)*",
+    re.DOTALL,
+)
+ZWJ_JOINED_REGEX = re.compile("\u200d([^\u200d])")
+EMOJI_PRESENTATION_REGEX = re.compile("(?<![\u200d\ufe0f])([^\u200d\ufe0f])\ufe0f")
+
+
+class WidthEngine:
+    # display widths per grapheme cluster. strings are translated against lookup
+    # tables holding the east asian width and grapheme break class of each code
+    # point, so the common case never runs python code per character
+    OTHER, EXTEND, ZWJ, REGIONAL, CONTROL, L, V, T, LV, LVT = range(10)
+    # code point -> chr(width) / chr(class). ascii is precomputed, everything else
+    # is added the first time it is seen
+    WIDTHS: "dict[int, str]" = {
+        cp: "\0" if cp < 32 or cp == 127 else "\1" for cp in range(128)
+    }
+    CLASSES: "dict[int, str]" = {
+        cp: "\4" if cp < 32 or cp == 127 else "\0"
+        for cp in range(128)  # CONTROL, OTHER
+    }
+    # classes that can join a code point to its neighbour
+    JOINING = tuple(chr(cls) for cls in (EXTEND, ZWJ, REGIONAL, L, V, T))
+
+    @staticmethod
+    def classify(cp: int) -> "tuple[int, int]":
+        char = chr(cp)
+        category = unicodedata.category(char)
+        if cp == 0x200D:
+            cls = WidthEngine.ZWJ
+        elif 0x1F1E6 <= cp <= 0x1F1FF:
+            cls = WidthEngine.REGIONAL
+        elif (
+            category in ("Mn", "Me", "Mc")
+            or 0xFE00 <= cp <= 0xFE0F
+            or 0x1F3FB <= cp <= 0x1F3FF
+            or 0xE0020 <= cp <= 0xE007F
+        ):
+            cls = WidthEngine.EXTEND
+        elif category in ("Cc", "Zl", "Zp") or (category == "Cf" and cp != 0xAD):
+            cls = WidthEngine.CONTROL
+        elif 0x1100 <= cp <= 0x115F or 0xA960 <= cp <= 0xA97F:
+            cls = WidthEngine.L
+        elif 0x1160 <= cp <= 0x11A7 or 0xD7B0 <= cp <= 0xD7C6:
+            cls = WidthEngine.V
+        elif 0x11A8 <= cp <= 0x11FF or 0xD7CB <= cp <= 0xD7FB:
+            cls = WidthEngine.T
+        elif 0xAC00 <= cp <= 0xD7A3:
+            cls = WidthEngine.LV if (cp - 0xAC00) % 28 == 0 else WidthEngine.LVT
+        else:
+            cls = WidthEngine.OTHER
+        if cls in (
+            WidthEngine.EXTEND,
+            WidthEngine.ZWJ,
+            WidthEngine.CONTROL,
+            WidthEngine.V,
+            WidthEngine.T,
+        ):
+            width = 0
+        elif unicodedata.east_asian_width(char) in ("W", "F"):
+            width = 2
+        else:
+            width = 1
+        return width, cls
+
+    @staticmethod
+    def widths(text: str) -> str:
+        widths = text.translate(WidthEngine.WIDTHS)
+        if not widths.isascii():
+            # code points missing from the tables are left as they are
+            for char in set(widths):
+                if char > "\x7f":
+                    width, cls = WidthEngine.classify(ord(char))
+                    WidthEngine.WIDTHS[ord(char)] = chr(width)
+                    WidthEngine.CLASSES[ord(char)] = chr(cls)
+            widths = text.translate(WidthEngine.WIDTHS)
+        return widths
+
+    @staticmethod
+    def width(text: str) -> int:
+        if text.isascii():
+            return len(text)
+        widths = WidthEngine.widths(text)
+        width = len(widths) - widths.count("\0") + widths.count("\2")
+        if "\u200d" in text or "\ufe0f" in text:
+            # zwj sequences are as wide as their first emoji, and emoji
+            # presentation widens a narrow base to two cells
+            joined = "".join(ZWJ_JOINED_REGEX.findall(text)).translate(
+                WidthEngine.WIDTHS
+            )
+            width -= len(joined) - joined.count("\0") + joined.count("\2")
+            presented = "".join(EMOJI_PRESENTATION_REGEX.findall(text))
+            width += presented.translate(WidthEngine.WIDTHS).count("\1")
+        return width
+
+    @staticmethod
+    def segment(text: str) -> "tuple[list[int] | range, list[int]]":
+        # grapheme cluster boundaries (including the end of the string) and the
+        # display width of each cluster
+        widths = WidthEngine.widths(text)
+        classes = text.translate(WidthEngine.CLASSES)
+        if not any(cls in classes for cls in WidthEngine.JOINING):
+            # every code point is a cluster of its own
+            return range(len(text) + 1), list(map(ord, widths))
+        parts = GRAPHEME_CLASS_REGEX.findall(classes)
+        bounds = [0, *itertools.accumulate(map(len, parts))]
+        cluster_widths = [ord(widths[start]) for start in bounds[:-1]]
+        for idx in [idx for idx, part in enumerate(parts) if len(part) > 1]:
+            if parts[idx][0] == "\3" or "\ufe0f" in text[bounds[idx] : bounds[idx + 1]]:
+                # emoji presentation and flags take two cells
+                cluster_widths[idx] = 2
+        return bounds, cluster_widths
+
+    @staticmethod
+    def clusters(text: str) -> "list[tuple[str, int]]":
+        bounds, widths = WidthEngine.segment(text)
+        return [
+            (text[bounds[idx] : bounds[idx + 1]], width)
+            for idx, width in enumerate(widths)
+        ]
+
+    @staticmethod
+    def wrap(text: str, limit: float) -> "list[str]":
+        # greedy wrap: a line takes clusters until its width reaches the limit.
+        # the break points are found by bisecting the running total
+        bounds, widths = WidthEngine.segment(text)
+        totals = list(itertools.accumulate(widths))
+        lines = []
+        start, base = 0, 0
+        while start < len(widths):
+            end = bisect.bisect_left(totals, base + limit, start) + 1
+            end = min(end, len(widths))
+            lines.append(text[bounds[start] : bounds[end]])
+            base = totals[end - 1]
+            start = end
+        return lines
+
+
+class InputWaiter:
+    # blocks until stdin is readable, wake() is called or the timeout runs out.
+    # woken is set when the wait ended because of wake() or a signal. headless
+    # players don't read stdin at all and only wake up for wake() and timeouts
+    selector: "selectors.BaseSelector | None"
+    woken: "bool"
+    wake_fds: "tuple[int, int] | None"
+
+    def __init__(self, stdin: bool = True):
+        self.selector = None
+        self.woken = False
+        self.wake_fds = None
+        if UNIX_TTY:
+            self.selector = selectors.DefaultSelector()
+            if stdin:
+                self.selector.register(sys.stdin.fileno(), selectors.EVENT_READ)
+            self.wake_fds = os.pipe()
+            for fd in self.wake_fds:
+                os.set_blocking(fd, False)
+            self.selector.register(self.wake_fds[0], selectors.EVENT_READ)
+
+    def wake(self) -> None:
+        if self.wake_fds is not None:
+            with contextlib.suppress(BlockingIOError):
+                os.write(self.wake_fds[1], b"\0")
+
+    def wait(self, timeout: "float | None") -> str:
+        self.woken = False
+        if self.selector is not None:
+            keys = ""
+            for key, _ in self.selector.select(timeout):
+                if key.fd == self.wake_fds[0]:
+                    with contextlib.suppress(BlockingIOError):
+                        os.read(self.wake_fds[0], 1024)
+                    self.woken = True
+                    continue
+                read = IOUtilities.read_keys()
+                if read is None:
+                    self.selector.unregister(sys.stdin.fileno())
+                    continue
+                keys += read
+            return keys
+        # consoles can't be selected on windows, so poll at a slow rate instead
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            keys = IOUtilities.read_keys()
+            if keys:
+                return keys
+            time.sleep(
+                0.05
+                if deadline is None
+                else min(0.05, max(deadline - time.monotonic(), 0))
+            )
+        return ""
+
+    def close(self):
+        if self.selector is not None:
+            self.selector.close()
+        if self.wake_fds is not None:
+            for fd in self.wake_fds:
+                os.close(fd)
+
+
+class ControlServer:
+    # the player's controls on a unix domain socket. every request is one line of
+    # json and gets one line of json back. requests are handed to the play loop and
+    # answered from there, so the player's state is only ever touched by one thread
+    REPLY_TIMEOUT = 10
+    path: "str"
+    waiter: "InputWaiter"
+    listener: "socket.socket"
+    requests: "collections.deque[tuple[dict, futures.Future]]"
+
+    def __init__(self, path: str, waiter: "InputWaiter"):
+        self.path = path
+        self.waiter = waiter
+        self.requests = collections.deque()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            # left behind by a player that didn't exit cleanly, unless it's still up
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(path)
+                except OSError:
+                    os.unlink(path)
+                else:
+                    raise OSError(f"another player is listening on {path}")
+        self.listener.bind(path)
+        self.listener.listen()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection: "socket.socket") -> None:
+        with connection, connection.makefile("rwb") as stream:
+            for line in stream:
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("requests are json objects")
+                except ValueError as e:
+                    response = {"ok": False, "error": f"bad request: {e}"}
+                else:
+                    future = futures.Future()
+                    self.requests.append((request, future))
+                    self.waiter.wake()
+                    try:
+                        response = future.result(ControlServer.REPLY_TIMEOUT)
+                    except futures.TimeoutError:
+                        response = {"ok": False, "error": "the player didn't respond"}
+                try:
+                    stream.write(json.dumps(response).encode() + b"\n")
+                    stream.flush()
+                except OSError:
+                    return
+
+    def pending(self) -> "Iterator[tuple[dict, futures.Future]]":
+        while self.requests:
+            yield self.requests.popleft()
+
+    def close(self) -> None:
+        self.listener.close()
+        with contextlib.suppress(OSError):
+            os.unlink(self.path)
+
+
+class TerminalRenderer:
+    # keeps the last frame around and only rewrites the cells that changed, as a
+    # single write. the terminal size is cached and refreshed on SIGWINCH
+    columns: "int"
+    resized: "bool"
+    previous: "list[str] | None"
+    previous_rows: "list[int]"
+    reusable_rows: "int"
+
+    def __init__(self, waiter: "InputWaiter | None" = None):
+        self.columns = shutil.get_terminal_size().columns
+        self.resized = False
+        self.previous = None
+        self.previous_rows = []
+        self.reusable_rows = 0
+        if hasattr(signal, "SIGWINCH"):
+            signal.signal(signal.SIGWINCH, self.on_resize)
+            if waiter is not None and waiter.wake_fds is not None:
+                # the handler alone wouldn't interrupt the selector, so the pipe does
+                signal.set_wakeup_fd(waiter.wake_fds[1], warn_on_full_buffer=False)
+
+    def on_resize(self, *args):
+        self.resized = True
+
+    def refresh_geometry(self) -> None:
+        if self.resized or not hasattr(signal, "SIGWINCH"):
+            self.resized = False
+            columns = shutil.get_terminal_size().columns
+            if columns != self.columns:
+                self.columns = columns
+                self.previous = None
+
+    def rows(self, line: str) -> int:
+        return max(math.ceil(IOUtilities.term_length(line) / self.columns), 1)
+
+    @staticmethod
+    def cells(line: str) -> "list[tuple[str, str, int]]":
+        # (active sgr sequence, grapheme cluster, width) for everything printed
+        result = []
+        sgr = ""
+        for part in re.split(f"({ANSI_REGEX.pattern})", line):
+            if ANSI_REGEX.fullmatch(part):
+                sgr = "" if part == "\x1b[0m" else part
+            elif part.isascii():
+                result.extend((sgr, char, 1) for char in part)
+            else:
+                result.extend(
+                    (sgr, cluster, width)
+                    for cluster, width in WidthEngine.clusters(part)
+                )
+        return result
+
+    @staticmethod
+    def move(rows: int) -> str:
+        if rows > 0:
+            return f"\x1b[{rows}B"
+        if rows < 0:
+            return f"\x1b[{-rows}A"
+        return ""
+
+    @staticmethod
+    def write_cells(cells: "list[tuple[str, str, int]]", column: int) -> str:
+        out = "\r" + (f"\x1b[{column}C" if column > 0 else "")
+        sgr = ""
+        for cell_sgr, char, _ in cells:
+            if cell_sgr != sgr:
+                out += "\x1b[0m" + cell_sgr
+                sgr = cell_sgr
+            out += char
+        return out + ("\x1b[0m" if sgr else "")
+
+    def diff_line(self, old: str, new: str) -> str:
+        old_cells, new_cells = TerminalRenderer.cells(old), TerminalRenderer.cells(new)
+        widths = [width for _, _, width in new_cells]
+        if len(old_cells) == len(new_cells) and widths == [
+            width for _, _, width in old_cells
+        ]:
+            # same layout, so only the runs of changed cells (timers, bar tail) are sent
+            out = ""
+            idx = 0
+            while idx < len(new_cells):
+                if old_cells[idx] == new_cells[idx]:
+                    idx += 1
+                    continue
+                end = idx + 1
+                while end < len(new_cells) and (
+                    old_cells[end] != new_cells[end]
+                    or any(
+                        old_cells[k] != new_cells[k]
+                        for k in range(end + 1, min(end + 4, len(new_cells)))
+                    )
+                ):
+                    end += 1
+                out += TerminalRenderer.write_cells(
+                    new_cells[idx:end], sum(widths[:idx])
+                )
+                idx = end
+            return out
+        same = 0
+        for old_cell, new_cell in zip(old_cells, new_cells):
+            if old_cell != new_cell:
+                break
+            same += 1
+        return (
+            TerminalRenderer.write_cells(new_cells[same:], sum(widths[:same]))
+            + "\x1b[K"
+        )
+
+    def draw(self, lines: "list[str]") -> None:
+        self.refresh_geometry()
+        rows = [self.rows(line) for line in lines]
+        if self.previous is None or rows != self.previous_rows:
+            # cursor sits at the start of the last row of the previous frame
+            top = (
+                sum(self.previous_rows) - 1
+                if self.previous is not None
+                else self.reusable_rows
+            )
+            out = (
+                "\r"
+                + TerminalRenderer.move(-top)
+                + "\x1b[J"
+                + "\r\n".join(lines)
+                + "\r"
+            )
+        else:
+            out = ""
+            cursor = sum(rows) - 1
+            row = 0
+            for idx, line in enumerate(lines):
+                if line != self.previous[idx]:
+                    out += TerminalRenderer.move(row - cursor)
+                    cursor = row
+                    if rows[idx] == 1:
+                        out += self.diff_line(self.previous[idx], line)
+                    else:
+                        out += "\r" + line + "\x1b[K"
+                        cursor += rows[idx] - 1
+                row += rows[idx]
+            if out == "":
+                return
+            out += TerminalRenderer.move(sum(rows) - 1 - cursor) + "\r"
+        self.previous = lines
+        self.previous_rows = rows
+        self.reusable_rows = 0
+        sys.stdout.write(out)
+        sys.stdout.flush()
+
+    def finish(self) -> None:
+        # leave the first line of the frame behind as history; the rest is reused
+        if self.previous is None:
+            return
+        sys.stdout.write("\r\n")
+        sys.stdout.flush()
+        self.reusable_rows = sum(self.previous_rows) - self.previous_rows[0]
+        self.previous = None
+        self.previous_rows = []
+
+
+class BackgroundWorker:
+    # a single long-lived thread for everything that talks to the network. jobs are
+    # keyed by channel, and submitting to a channel replaces whatever was still
+    # pending there, so only the latest share or presence state is ever sent
+    pending: "dict[str, tuple[float, Any, tuple, dict]]"
+    condition: "threading.Condition"
+    _session: "requests.Session | None"
+    thread: "threading.Thread"
+    running: "bool"
+
+    def __init__(self):
+        self.pending = {}
+        self.condition = threading.Condition()
+        self._session = None
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.loop, name="inflo-worker", daemon=True
+        )
+        self.thread.start()
+
+    @property
+    def session(self) -> "requests.Session":
+        # created on the worker thread the first time it's needed, which keeps the
+        # requests import off the startup path
+        if self._session is None:
+            self._session = requests.Session()
+        return self._session
+
+    def submit(self, channel: str, target, *args, **kwargs) -> None:
+        self.schedule(channel, 0, target, *args, **kwargs)
+
+    def schedule(self, channel: str, delay: float, target, *args, **kwargs) -> None:
+        with self.condition:
+            # re-inserting moves the channel behind everything submitted before it
+            self.pending.pop(channel, None)
+            self.pending[channel] = (time.monotonic() + delay, target, args, kwargs)
+            self.condition.notify()
+
+    def loop(self) -> None:
+        while True:
+            with self.condition:
+                while self.running:
+                    now = time.monotonic()
+                    channel = next(
+                        (c for c, job in self.pending.items() if job[0] <= now), None
+                    )
+                    if channel is not None:
+                        break
+                    self.condition.wait(
+                        min(job[0] for job in self.pending.values()) - now
+                        if self.pending
+                        else None
+                    )
+                if not self.running:
+                    return
+                _, target, args, kwargs = self.pending.pop(channel)
+            try:
+                target(*args, **kwargs)
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self._session is not None:
+            self._session.close()
+
+
+class MetadataCache:
+    # inflo-api results (thumbnail and channel title) per youtube id, kept on disk
+    # so restarts don't fetch the whole library again. entries expire after ttl
+    # seconds and the least recently used ones are evicted past max_entries. recent
+    # lookups are also kept in memory, so repeats don't touch the database
+    MEMORY_CACHE = "metadata"
+    path: "str"
+    api_url: "str"
+    ttl: "float"
+    max_entries: "int"
+    hits: "int"
+    misses: "int"
+    memory: "BoundedCache"
+    connection: "sqlite3.Connection"
+    lock: "threading.Lock"
+    _session: "requests.Session | None"
+
+    def __init__(
+        self,
+        path: str = METADATA_CACHE_FILE,
+        api_url: str = INFLO_API_URL,
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 50000,
+    ):
+        self.path = path
+        self.api_url = api_url if api_url.endswith("/") else api_url + "/"
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        METRICS.register_cache(
+            "metadata_disk", lambda: {"hits": self.hits, "misses": self.misses}
+        )
+        # held for at most an hour, so entries can outlive the ttl by that much
+        self.memory = BoundedCache(
+            MetadataCache.MEMORY_CACHE, max_entries=1024, ttl=min(ttl, 3600)
+        )
+        self.lock = threading.Lock()
+        self._session = None
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (video_id TEXT PRIMARY KEY, maxres TEXT NOT NULL, channel_title TEXT, fetched REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used)"
+        )
+        self.connection.commit()
+
+    def get(self, video_id: str) -> "tuple[str, str | None] | None":
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT maxres, channel_title, fetched FROM metadata WHERE video_id = ?",
+                (video_id,),
+            ).fetchone()
+            if row is None or now - row[2] > self.ttl:
+                return None
+            self.connection.execute(
+                "UPDATE metadata SET used = ? WHERE video_id = ?", (now, video_id)
+            )
+            self.connection.commit()
+        return row[0], row[1]
+
+    def put(self, video_id: str, maxres: str, channel_title: "str | None") -> None:
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                (video_id, maxres, channel_title, now, now),
+            )
+            (count,) = self.connection.execute(
+                "SELECT COUNT(*) FROM metadata"
+            ).fetchone()
+            if count > self.max_entries:
+                # evict a tenth at a time so inserts near the limit stay cheap
+                self.connection.execute(
+                    "DELETE FROM metadata WHERE video_id IN (SELECT video_id FROM metadata ORDER BY used LIMIT ?)",
+                    (count - self.max_entries + self.max_entries // 10,),
+                )
+            self.connection.commit()
+        self.memory.put(video_id, (maxres, channel_title))
+
+    @property
+    def session(self) -> "requests.Session":
+        # for callers that don't pass their own, created the first time it's needed
+        with self.lock:
+            if self._session is None:
+                self._session = requests.Session()
+            return self._session
+
+    def fetch(
+        self,
+        video_id: str,
+        session: "requests.Session | None" = None,
+        timeout: float = 1,
+    ) -> "tuple[str, str | None]":
+        api_result = (
+            (session or self.session)
+            .get(self.api_url + video_id, timeout=timeout)
+            .json()
+        )
+        self.put(video_id, api_result["maxres"], api_result["channelTitle"])
+        return api_result["maxres"], api_result["channelTitle"]
+
+    def lookup(
+        self, video_id: str, session: "requests.Session | None" = None
+    ) -> "tuple[str, str | None]":
+        cached = self.memory.get(video_id)
+        if cached is not None:
+            return cached
+        cached = self.get(video_id)
+        if cached is not None:
+            self.hits += 1
+            self.memory.put(video_id, cached)
+            return cached
+        self.misses += 1
+        return self.fetch(video_id, session)
+
+    def missing(self, video_ids: "list[str]") -> "list[str]":
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            cached = {
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT video_id FROM metadata WHERE fetched >= ?", (cutoff,)
+                )
+            }
+        return [
+            video_id for video_id in dict.fromkeys(video_ids) if video_id not in cached
+        ]
+
+    def warm(self, video_ids: "list[str]", parallelism: int = 8) -> "threading.Thread":
+        # fetches everything not cached yet in the background, at most parallelism
+        # requests at a time. failures are left for the next lookup to retry
+        def run():
+            missing = self.missing(video_ids)
+            if not missing:
+                return
+            session = requests.Session()
+            session.mount(
+                "https://",
+                requests.adapters.HTTPAdapter(pool_maxsize=parallelism),
+            )
+            session.mount(
+                "http://",
+                requests.adapters.HTTPAdapter(pool_maxsize=parallelism),
+            )
+            with futures.ThreadPoolExecutor(parallelism) as pool:
+                for future in [
+                    pool.submit(self.fetch, video_id, session, NETWORK_TIMEOUT)
+                    for video_id in missing
+                ]:
+                    with contextlib.suppress(Exception):
+                        future.result()
+            session.close()
+
+        thread = threading.Thread(target=run, name="inflo-metadata-warm", daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.connection.close()
+        if self._session is not None:
+            self._session.close()
+
+
+class PresencePublisher:
+    # owns the discord connection. identical payloads are skipped, timestamps are
+    # only resent once they drift, and updates are held back by a token bucket
+    # matching discord's limit of 5 activity updates per 20 seconds. everything here
+    # runs on the worker thread
+    RATE_CAPACITY = 5
+    RATE_PERIOD = 20
+    TIMESTAMP_DRIFT = 2
+    MAX_BACKOFF = 60
+    JOIN_TIME_REGEX = re.compile(r"&t=\d+")
+
+    presence: "pypresence.Presence | None"
+    worker: "BackgroundWorker"
+    client_id: "str"
+    last_payload: "dict[str, Any] | None"
+    tokens: "float"
+    refilled: "float"
+    reconnect_attempts: "int"
+    sent: "int"
+    skipped: "int"
+    failed: "int"
+
+    def __init__(
+        self,
+        presence: "pypresence.Presence | None",
+        worker: "BackgroundWorker",
+        client_id: str = DISCORD_CLIENT_ID,
+    ):
+        self.presence = presence
+        self.worker = worker
+        self.client_id = client_id
+        self.last_payload = None
+        self.tokens = self.RATE_CAPACITY
+        self.refilled = time.monotonic()
+        self.reconnect_attempts = 0
+        self.sent = self.skipped = self.failed = 0
+
+    @staticmethod
+    def identity(payload: "dict[str, Any]") -> "tuple":
+        # everything visible except the timestamps, and the youtube join offset,
+        # which moves along with them
+        return tuple(
+            sorted(
+                (
+                    key,
+                    (
+                        json.dumps(value, sort_keys=True)
+                        if key != "buttons"
+                        else PresencePublisher.JOIN_TIME_REGEX.sub(
+                            "", json.dumps(value, sort_keys=True)
+                        )
+                    ),
+                )
+                for key, value in payload.items()
+                if key not in ("start", "end")
+            )
+        )
+
+    def is_redundant(self, payload: "dict[str, Any]") -> bool:
+        last = self.last_payload
+        if last is None or self.identity(last) != self.identity(payload):
+            return False
+        for key in ("start", "end"):
+            if (key in last) != (key in payload):
+                return False
+            if key in payload and abs(payload[key] - last[key]) > self.TIMESTAMP_DRIFT:
+                return False
+        return True
+
+    def take_token(self) -> float:
+        # returns 0 when a token was taken, otherwise how long until one is available
+        now = time.monotonic()
+        self.tokens = min(
+            self.RATE_CAPACITY,
+            self.tokens + (now - self.refilled) * self.RATE_CAPACITY / self.RATE_PERIOD,
+        )
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * self.RATE_PERIOD / self.RATE_CAPACITY
+
+    def publish(self, payload: "dict[str, Any]") -> None:
+        if self.presence is None:
+            return
+        if self.is_redundant(payload):
+            self.skipped += 1
+            return
+        wait = self.take_token()
+        if wait > 0:
+            # retried on the same channel, so a newer payload replaces this one
+            self.worker.schedule("presence", wait, self.publish, payload)
+            return
+        try:
+            with contextlib.redirect_stderr(None):
+                self.presence.update(**payload)
+            self.last_payload = payload
+            self.sent += 1
+        except Exception as e:
+            self.failed += 1
+            if isinstance(e, pypresence.PipeClosed):
+                self.reconnect()
+                return
+            try:
+                self.presence.close()
+            except Exception:
+                pass
+            self.presence = None
+
+    def connect(self) -> None:
+        # the first connection, made in the background once playback started
+        self.reconnect(retry=False)
+        if self.presence is not None:
+            TIMINGS.mark("presence connected")
+
+    def reconnect(self, retry: bool = True) -> None:
+        with contextlib.redirect_stderr(None):
+            if self.presence is not None:
+                try:
+                    self.presence.close()
+                except Exception:
+                    pass
+            try:
+                self.presence = pypresence.Presence(self.client_id)
+                self.presence.connect()
+            except Exception:
+                self.presence = None
+                if not retry:
+                    return
+                self.reconnect_attempts += 1
+                self.worker.schedule(
+                    "presence-reload",
+                    min(2**self.reconnect_attempts, self.MAX_BACKOFF),
+                    self.reconnect,
+                )
+                return
+        self.reconnect_attempts = 0
+        # the new connection starts out blank, so the next payload has to go out
+        self.last_payload = None
+
+    def close(self) -> None:
+        if self.presence is not None:
+            try:
+                self.presence.close()
+            except Exception:
+                pass
+
+    def stats(self) -> str:
+        return (
+            f"presence sent {self.sent}, skipped {self.skipped}, failed {self.failed}"
+        )
+
+
+class ShareClient:
+    # keeps the share server in step with the player. pushes wait a moment on the
+    # worker's share channel, so a burst of pauses only sends the last state, and
+    # unchanged state is only resent to correct drift. failures back off
+    # exponentially, and a share the server has forgotten is started again.
+    # everything but push runs on the worker thread
+    DEBOUNCE = 0.25
+    RESYNC_INTERVAL = 30
+    PROGRESS_DRIFT = 1
+    MAX_BACKOFF = 60
+    worker: "BackgroundWorker"
+    url: "str"
+    secret: "str | None"
+    share_id: "str | None"
+    last_state: "tuple[str | None, float, bool, float] | None"
+    failures: "int"
+    retry_at: "float"
+    sent: "int"
+    skipped: "int"
+    failed: "int"
+
+    def __init__(self, worker: "BackgroundWorker", url: str = INFLO_SHARE_URL):
+        self.worker = worker
+        self.url = url if url.endswith("/") else url + "/"
+        self.secret = None
+        self.share_id = None
+        self.last_state = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self.sent = self.skipped = self.failed = 0
+
+    def push(self, youtube_id: "str | None", progress: float, playing: bool) -> None:
+        self.worker.schedule(
+            "share",
+            self.DEBOUNCE,
+            self.send,
+            youtube_id,
+            progress,
+            playing,
+            time.monotonic(),
+        )
+
+    def is_redundant(
+        self, youtube_id: "str | None", progress: float, playing: bool, now: float
+    ) -> bool:
+        last = self.last_state
+        if last is None or (last[0], last[2]) != (youtube_id, playing):
+            return False
+        if now - last[3] >= self.RESYNC_INTERVAL:
+            return False
+        expected = last[1] + (now - last[3] if playing else 0)
+        return abs(progress - expected) <= self.PROGRESS_DRIFT
+
+    def start(self) -> None:
+        share = self.worker.session.post(
+            self.url + "start", timeout=NETWORK_TIMEOUT
+        ).json()
+        self.secret, self.share_id = share["secret"], share["id"]
+        self.last_state = None
+
+    def put(self, youtube_id: "str | None", progress: float, playing: bool) -> str:
+        return self.worker.session.put(
+            self.url + "update/" + self.secret,
+            json={"playing": playing, "id": youtube_id, "progress": progress},
+            timeout=NETWORK_TIMEOUT,
+        ).json()["status"]
+
+    def send(
+        self, youtube_id: "str | None", progress: float, playing: bool, pushed: float
+    ) -> None:
+        now = time.monotonic()
+        if playing:
+            progress += now - pushed
+        if now < self.retry_at:
+            # still backing off, the latest state goes out with the retry
+            self.worker.schedule(
+                "share",
+                self.retry_at - now,
+                self.send,
+                youtube_id,
+                progress,
+                playing,
+                now,
+            )
+            return
+        if self.is_redundant(youtube_id, progress, playing, now):
+            self.skipped += 1
+            return
+        try:
+            if self.secret is None:
+                self.start()
+            if self.put(youtube_id, progress, playing) == "fail":
+                self.start()
+                if self.put(youtube_id, progress, playing) == "fail":
+                    raise ValueError("the share server rejected the update")
+        except Exception:
+            self.failed += 1
+            self.failures += 1
+            delay = min(2**self.failures, self.MAX_BACKOFF)
+            self.retry_at = now + delay
+            self.worker.schedule(
+                "share", delay, self.send, youtube_id, progress, playing, now
+            )
+            return
+        self.failures = 0
+        self.sent += 1
+        self.last_state = (youtube_id, progress, playing, now)
+
+    def stats(self) -> str:
+        return f"share sent {self.sent}, skipped {self.skipped}, failed {self.failed}"
+
+
+class Track(NamedTuple):
+    id: "int"
+    path: "str"
+    mtime: "int"
+    size: "int"
+    # None if it couldn't be probed
+    length: "float | None"
+    youtube_id: "str | None"
+    display_name: "str"
+    # loudness correction in db, None until it has been measured
+    gain: "float | None" = None
+
+
+class LibraryIndex:
+    # sqlite index of the library keyed by path, mtime and size. the roots are walked
+    # recursively, but once indexed a directory is only listed again when its mtime
+    # changes. lengths of new or changed files are probed on a thread pool and
+    # committed in batches, so the player can start before a large scan finishes.
+    # files whose length couldn't be probed are stored without one and probed
+    # again on the next scan that sees them, or when they're played. ids are never
+    # reused, since the play history is keyed by them
+    BATCH_SIZE = 256
+    BATCH_INTERVAL = 0.5
+    path: "str"
+    roots: "list[str]"
+    workers: "int"
+    connection: "sqlite3.Connection"
+    lock: "threading.RLock"
+    scanning: "threading.Lock"
+    ready: "threading.Event"
+    closed: "bool"
+    tracks: "dict[str, Track]"
+    version: "int"
+    probed: "int"
+    probing: "int"
+    scan_started: "float"
+    last_scan: "tuple[int, int, float] | None"
+    _files: "list[str] | None"
+    _dirs: "dict[str, int]"
+
+    def __init__(
+        self,
+        path: str = LIBRARY_INDEX_FILE,
+        roots: "list[str] | None" = None,
+        workers: int = 8,
+    ):
+        self.path = path
+        self.roots = [os.path.normpath(root) for root in roots or ["."]]
+        self.workers = workers
+        self.lock = threading.RLock()
+        self.scanning = threading.Lock()
+        self.ready = threading.Event()
+        self.closed = False
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE NOT NULL, mtime INTEGER NOT NULL, size INTEGER NOT NULL, length REAL, youtube_id TEXT, display_name TEXT NOT NULL, gain REAL)"
+        )
+        self.connection.commit()
+        self.tracks = {}
+        self.version = 0
+        self.probed = self.probing = 0
+        self.scan_started = 0.0
+        self.last_scan = None
+        self._files = None
+        self._dirs = {}
+        self._load()
+
+    @staticmethod
+    def describe(path: str) -> "tuple[str | None, str]":
+        name = os.path.basename(path)
+        if name.endswith(".mp3"):
+            name = name[: -len(".mp3")]
+        name = IOUtilities.normalize(name.strip())
+        match = YOUTUBE_DL_ID_REGEX.search(name)
+        return (match.group(0).strip("[]") if match else None), name
+
+    @staticmethod
+    def parent(path: str) -> str:
+        return os.path.dirname(path) or "."
+
+    @staticmethod
+    def dir_mtime(directory: str) -> "int | None":
+        try:
+            return os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self):
+        with self.lock:
+            self.tracks = {
+                row[1]: Track(*row)
+                for row in self.connection.execute(
+                    "SELECT id, path, mtime, size, length, youtube_id, display_name, gain FROM tracks"
+                )
+            }
+            self._files = None
+            self.version += 1
+        if self.tracks:
+            self.ready.set()
+
+    def _store(
+        self, path: str, mtime: int, size: int, length: "float | None"
+    ) -> "Track":
+        youtube_id, display_name = LibraryIndex.describe(path)
+        (track_id,) = self.connection.execute(
+            "INSERT INTO tracks (path, mtime, size, length, youtube_id, display_name) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET mtime=excluded.mtime, size=excluded.size, length=excluded.length, "
+            "youtube_id=excluded.youtube_id, display_name=excluded.display_name, gain=NULL RETURNING id",
+            (path, mtime, size, length, youtube_id, display_name),
+        ).fetchone()
+        track = Track(track_id, path, mtime, size, length, youtube_id, display_name)
+        self.tracks[path] = track
+        return track
+
+    def _commit(
+        self,
+        rows: "list[tuple[str, int, int, float | None]]",
+        removed: "list[str] | None" = None,
+    ) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            for row in rows:
+                self._store(*row)
+            if removed:
+                self.connection.executemany(
+                    "DELETE FROM tracks WHERE path = ?", [(path,) for path in removed]
+                )
+                for path in removed:
+                    self.tracks.pop(path, None)
+            self.connection.commit()
+            self._files = None
+            self.version += 1
+        if self.tracks:
+            self.ready.set()
+
+    @staticmethod
+    def walk(
+        directories: "list[str]", known: "dict[str, int] | None" = None
+    ) -> "tuple[dict[str, tuple[int, int]], dict[str, int]]":
+        # lists the given directories, and below them every directory that isn't
+        # already known. like os.walk, hidden and symlinked directories are skipped.
+        on_disk: "dict[str, tuple[int, int]]" = {}
+        listed: "dict[str, int]" = {}
+        pending = list(directories)
+        while pending:
+            directory = pending.pop()
+            mtime = LibraryIndex.dir_mtime(directory)
+            if mtime is None:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        path = (
+                            entry.name
+                            if directory == "."
+                            else os.path.join(directory, entry.name)
+                        )
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith(".") and (
+                                known is None or path not in known
+                            ):
+                                pending.append(path)
+                        elif entry.name.endswith(".mp3") and entry.is_file():
+                            stat = entry.stat()
+                            on_disk[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                continue
+            listed[directory] = mtime
+        return on_disk, listed
+
+    def scan(self, force: bool = False, probe: bool = True) -> bool:
+        # a scan that is already running, e.g. in the background, is not waited on.
+        # without probing, new and changed files are stored without a length, for
+        # the next scan that probes to fill in
+        if not self.scanning.acquire(blocking=False):
+            return False
+        try:
+            return self._scan(force, probe)
+        finally:
+            self.scanning.release()
+            self.ready.set()
+
+    def _scan(self, force: bool, probe: bool) -> bool:
+        full = force or not self._dirs
+        if full:
+            stale = self.roots
+        else:
+            stale = [
+                directory
+                for directory, mtime in self._dirs.items()
+                if LibraryIndex.dir_mtime(directory) != mtime
+            ]
+            if not stale:
+                return False
+        self.scan_started = time.perf_counter()
+        on_disk, listed = LibraryIndex.walk(stale, None if full else self._dirs)
+        with self.lock:
+            changed = [
+                path
+                for path, stat in on_disk.items()
+                if path not in self.tracks
+                or (self.tracks[path].mtime, self.tracks[path].size) != stat
+                or (probe and self.tracks[path].length is None)
+            ]
+            if full:
+                removed = [path for path in self.tracks if path not in on_disk]
+            else:
+                scope = set(stale) | set(listed)
+                removed = [
+                    path
+                    for path in self.tracks
+                    if path not in on_disk and LibraryIndex.parent(path) in scope
+                ]
+        if probe:
+            self.probed, self.probing = 0, len(changed)
+            if changed:
+                self.probe(changed, on_disk)
+        elif changed:
+            self._commit([(path, *on_disk[path], None) for path in changed])
+        if removed:
+            self._commit([], removed)
+        if full:
+            self._dirs = listed
+        else:
+            for directory in stale:
+                self._dirs.pop(directory, None)
+            self._dirs.update(listed)
+        self.last_scan = (
+            len(on_disk),
+            len(changed) if probe else 0,
+            time.perf_counter() - self.scan_started,
+        )
+        self.probing = 0
+        if full:
+            TIMINGS.mark("library scanned")
+            TIMINGS.note("library scan", self.throughput())
+        return bool(changed or removed)
+
+    def probe(
+        self, changed: "list[str]", on_disk: "dict[str, tuple[int, int]]"
+    ) -> None:
+        # only a few probes are queued at a time, so closing doesn't have to wait
+        # for the pool to work through the rest of the library
+        remaining = iter(changed)
+        running: "dict[futures.Future, str]" = {}
+        batch = []
+        flushed = time.monotonic()
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                while not self.closed and len(running) < self.workers * 2:
+                    path = next(remaining, None)
+                    if path is None:
+                        break
+                    running[pool.submit(LibraryIndex.probe_length, path)] = path
+                if not running:
+                    break
+                done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for job in done:
+                    path = running.pop(job)
+                    batch.append((path, *on_disk[path], job.result()))
+                    self.probed += 1
+                if (
+                    len(batch) >= LibraryIndex.BATCH_SIZE
+                    or time.monotonic() - flushed >= LibraryIndex.BATCH_INTERVAL
+                ):
+                    self._commit(batch)
+                    batch = []
+                    flushed = time.monotonic()
+        if batch:
+            self._commit(batch)
+
+    @staticmethod
+    def probe_length(path: str) -> "float | None":
+        try:
+            return IOUtilities.get_length(path)
+        except Exception:
+            return None
+
+    def start_scan(self, force: bool = False) -> "threading.Thread":
+        thread = threading.Thread(target=self.scan, args=(force,), daemon=True)
+        thread.start()
+        return thread
+
+    def progress(self) -> "str | None":
+        if self.probing == 0:
+            return None
+        rate = self.probed / max(time.perf_counter() - self.scan_started, 1e-9)
+        return f"scanning library: {self.probed}/{self.probing} ({rate:.0f} files/s)"
+
+    def throughput(self) -> "str | None":
+        if self.last_scan is None:
+            return None
+        files, probed, elapsed = self.last_scan
+        return f"library scan: {files} files, {probed} probed in {elapsed:.2f}s ({files / max(elapsed, 1e-9):.0f} files/s)"
+
+    def files(self) -> "list[str]":
+        with self.lock:
+            if self._files is None:
+                self._files = sorted(self.tracks)
+            return self._files
+
+    def get(self, path: str) -> "Track | None":
+        # a single stat catches files that were replaced in place or removed
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if path in self.tracks:
+                self._commit([], [path])
+            return None
+        track = self.tracks.get(path)
+        unchanged = track is not None and (track.mtime, track.size) == (
+            stat.st_mtime_ns,
+            stat.st_size,
+        )
+        if unchanged and track.length is not None:
+            return track
+        length = LibraryIndex.probe_length(path)
+        if unchanged and length is None:
+            # still unknown, nothing to write
+            return track
+        with self.lock:
+            track = self._store(path, stat.st_mtime_ns, stat.st_size, length)
+            self.connection.commit()
+            self._files = None
+            self.version += 1
+        return track
+
+    def get_length(self, path: str) -> float:
+        track = self.get(path)
+        return (track.length if track is not None else None) or 0
+
+    def unanalyzed(self) -> "list[Track]":
+        with self.lock:
+            return [track for track in self.tracks.values() if track.gain is None]
+
+    def set_gain(self, path: str, mtime: int, size: int, gain: float) -> None:
+        # only applies to the version of the file that was measured. the version
+        # isn't bumped, since nothing sampled or searched depends on the gain
+        with self.lock:
+            if self.closed:
+                return
+            self.connection.execute(
+                "UPDATE tracks SET gain = ? WHERE path = ? AND mtime = ? AND size = ?",
+                (gain, path, mtime, size),
+            )
+            self.connection.commit()
+            track = self.tracks.get(path)
+            if track is not None and (track.mtime, track.size) == (mtime, size):
+                self.tracks[path] = track._replace(gain=gain)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.connection.close()
+
+
+class LoudnessAnalyzer:
+    # measures the integrated loudness (ebu r128) of the library with ffmpeg and
+    # stores the gain that brings each track to the target in the library index.
+    # a few ffmpeg processes run at a time at the lowest priority, and playback
+    # never waits on them: tracks that haven't been measured play at unity gain
+    LOUDNESS_REGEX = re.compile(r"I:\s+(-?[\d.]+) LUFS")
+    RESCAN_INTERVAL = 30
+    library: "LibraryIndex"
+    workers: "int"
+    target: "float"
+    running: "bool"
+    stopped: "threading.Event"
+    lock: "threading.Lock"
+    processes: "set[subprocess.Popen]"
+    analyzed: "int"
+
+    def __init__(self, library: "LibraryIndex", workers: int = 2, target: float = -18):
+        self.library = library
+        self.workers = workers
+        self.target = target
+        self.running = False
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.analyzed = 0
+
+    @staticmethod
+    def linear(gain: "float | None") -> float:
+        # the mixer can't amplify, so quiet tracks stay at full volume
+        return 1.0 if gain is None else min(10 ** (gain / 20), 1.0)
+
+    def start(self) -> bool:
+        if shutil.which("ffmpeg") is None:
+            return False
+        self.running = True
+        threading.Thread(target=self.loop, name="inflo-loudness", daemon=True).start()
+        return True
+
+    def measure(self, path: str) -> "float | None":
+        command = [
+            "ffmpeg",
+            "-nostats",
+            "-hide_banner",
+            "-i",
+            path,
+            "-map",
+            "0:a:0",
+            "-af",
+            "ebur128",
+            "-f",
+            "null",
+            "-",
+        ]
+        options = {}
+        if os.name == "nt":
+            options["creationflags"] = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        elif shutil.which("nice") is not None:
+            command = ["nice", "-n", "19", *command]
+        try:
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                **options,
+            )
+        except OSError:
+            return None
+        with self.lock:
+            self.processes.add(process)
+        loudness = None
+        try:
+            # read as it's logged, so only the latest value is held rather than a
+            # line per frame of audio. the last one is the summary for the file
+            for line in process.stderr:
+                match = LoudnessAnalyzer.LOUDNESS_REGEX.search(
+                    line.decode("utf8", "replace")
+                )
+                if match is not None:
+                    loudness = match.group(1)
+            process.wait()
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+        if not self.running:
+            return None
+        # files ffmpeg can't measure are stored at unity, so they aren't retried
+        return self.target - float(loudness) if loudness is not None else 0.0
+
+    def drain(self, tracks: "Iterator[Track]") -> None:
+        while self.running:
+            with self.lock:
+                track = next(tracks, None)
+            if track is None:
+                return
+            gain = self.measure(track.path)
+            if gain is not None:
+                self.library.set_gain(track.path, track.mtime, track.size, gain)
+                self.analyzed += 1
+
+    def loop(self) -> None:
+        while self.running:
+            version = self.library.version
+            pending = iter(self.library.unanalyzed())
+            threads = [
+                threading.Thread(target=self.drain, args=(pending,), daemon=True)
+                for _ in range(self.workers)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # new or changed files are picked up once the library changes
+            while self.running and self.library.version == version:
+                self.stopped.wait(LoudnessAnalyzer.RESCAN_INTERVAL)
+
+    def close(self) -> None:
+        self.running = False
+        self.stopped.set()
+        with self.lock:
+            for process in self.processes:
+                with contextlib.suppress(OSError):
+                    process.kill()
+
+
+class SearchIndex:
+    # queue mode lookups over the library. completions are file names: prefix
+    # completion and cycling bisect the sorted names, anything else falls back to
+    # ranked substring/fuzzy matching.
+    library: "LibraryIndex"
+    names: "list[str]"
+    files: "list[str]"
+    folded: "list[str]"
+    _version: "int | None"
+    _last: "tuple[str, list[str]] | None"
+
+    def __init__(self, library: "LibraryIndex"):
+        self.library = library
+        self.names = []
+        self.files = []
+        self.folded = []
+        self._version = None
+        self._last = None
+
+    def sync(self) -> None:
+        if self._version == self.library.version:
+            return
+        # held so a scan in the background can't change the library halfway through
+        with self.library.lock:
+            files = self.library.files()
+            names = [os.path.basename(file) for file in files]
+            if names != files:
+                files = sorted(files, key=os.path.basename)
+                names = [os.path.basename(file) for file in files]
+            self.names, self.files = names, files
+            self.folded = [
+                self.library.tracks[file].display_name.casefold() for file in self.files
+            ]
+            self._version = self.library.version
+        self._last = None
+
+    def prefix_range(self, prefix: str) -> "tuple[int, int]":
+        self.sync()
+        lo = bisect.bisect_left(self.names, prefix)
+        hi = bisect.bisect_left(self.names, prefix + "\U0010ffff", lo)
+        return lo, hi
+
+    @staticmethod
+    def score(query: str, candidate: str) -> "tuple[int, int, int] | None":
+        # lower is better: (tier, position, length)
+        idx = candidate.find(query)
+        if idx == 0:
+            return 0, 0, len(candidate)
+        if idx > 0:
+            while idx != -1:
+                if not candidate[idx - 1].isalnum():
+                    return 1, idx, len(candidate)
+                idx = candidate.find(query, idx + 1)
+            return 2, candidate.find(query), len(candidate)
+        # subsequence match, ranked by how spread out the matched characters are
+        pos, first = 0, -1
+        for char in query:
+            pos = candidate.find(char, pos)
+            if pos == -1:
+                return None
+            if first == -1:
+                first = pos
+            pos += 1
+        return 3, pos - first - len(query), len(candidate)
+
+    def search(self, query: str, limit: int = 50) -> "list[str]":
+        self.sync()
+        query = IOUtilities.normalize(query).casefold().strip()
+        if query == "":
+            return []
+        if self._last is not None and self._last[0] == query:
+            return self._last[1]
+        ranked = []
+        for name, folded in zip(self.names, self.folded):
+            score = SearchIndex.score(query, folded)
+            if score is not None:
+                ranked.append((score, name))
+        ranked.sort()
+        result = [name for _, name in ranked[:limit]]
+        self._last = (query, result)
+        return result
+
+    def cycle(self, query: str, current: "str | None") -> "str | None":
+        lo, hi = self.prefix_range(query)
+        if lo < hi:
+            if current is None:
+                return self.names[lo]
+            idx = bisect.bisect_right(self.names, current, lo, hi)
+            return self.names[idx if idx < hi else lo]
+        ranked = self.search(query)
+        if len(ranked) == 0:
+            return None
+        if current in ranked:
+            return ranked[(ranked.index(current) + 1) % len(ranked)]
+        return ranked[0]
+
+    def resolve(self, query: str) -> "str | None":
+        name = self.cycle(query, None)
+        if name is None:
+            return None
+        return self.files[bisect.bisect_left(self.names, name)]
+
+
+class PlayHistory:
+    # plays and skips per library track id, kept in an append-only log of fixed size
+    # records and replayed into one small entry per track on startup. a play record
+    # carries a play count and a skip record a skip score, so compaction can rewrite
+    # the log as two records per track without losing anything. skip scores halve
+    # every skip_half_life seconds
+    RECORD = struct.Struct("<dIBf")
+    PLAY = 0
+    SKIP = 1
+    # the log is compacted once it has this many records per known track, plus slack
+    COMPACT_RATIO = 4
+    COMPACT_SLACK = 4096
+    # each remembered skip multiplies a track's chance of being accepted by this
+    SKIP_PENALTY = 0.5
+    path: "str"
+    library: "LibraryIndex"
+    recency_window: "float"
+    skip_half_life: "float"
+    # id -> [last played, plays, skip score, last skipped]
+    tracks: "dict[int, list[float]]"
+    records: "int"
+    file: "Any"
+    lock: "threading.Lock"
+
+    def __init__(
+        self,
+        path: str,
+        library: "LibraryIndex",
+        recency_window: float = 3600,
+        skip_half_life: float = 30 * 24 * 3600,
+    ):
+        self.path = path
+        self.library = library
+        self.recency_window = recency_window
+        self.skip_half_life = skip_half_life
+        self.tracks = {}
+        self.records = 0
+        self.lock = threading.Lock()
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            data = b""
+        # a record cut short by a crash is dropped
+        size = PlayHistory.RECORD.size
+        for record in PlayHistory.RECORD.iter_unpack(data[: len(data) // size * size]):
+            self.apply(*record)
+            self.records += 1
+        self.file = open(path, "ab")
+        if self.records > self.compact_limit():
+            self.compact()
+
+    def decayed(self, score: float, since: float, now: float) -> float:
+        return score * 0.5 ** (max(now - since, 0) / self.skip_half_life)
+
+    def apply(self, at: float, track_id: int, event: int, value: float) -> None:
+        entry = self.tracks.get(track_id)
+        if entry is None:
+            entry = self.tracks[track_id] = [0.0, 0.0, 0.0, 0.0]
+        if event == PlayHistory.PLAY:
+            entry[0] = max(entry[0], at)
+            entry[1] += value
+        elif event == PlayHistory.SKIP:
+            entry[2] = self.decayed(entry[2], entry[3], at) + value
+            entry[3] = max(entry[3], at)
+
+    def record(self, track_id: int, event: int) -> None:
+        now = time.time()
+        with self.lock:
+            self.apply(now, track_id, event, 1.0)
+            if self.file.closed:
+                return
+            self.file.write(PlayHistory.RECORD.pack(now, track_id, event, 1.0))
+            self.file.flush()
+            self.records += 1
+            if self.records > self.compact_limit():
+                self.compact()
+
+    def compact_limit(self) -> int:
+        return len(self.tracks) * PlayHistory.COMPACT_RATIO + PlayHistory.COMPACT_SLACK
+
+    def compact(self) -> None:
+        # rewrites the log as the current state, dropping tracks that left the library
+        with self.library.lock:
+            known = {track.id for track in self.library.tracks.values()}
+        self.tracks = {
+            track_id: entry
+            for track_id, entry in self.tracks.items()
+            if track_id in known
+        }
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as file:
+            for track_id, (played, plays, skips, skipped) in self.tracks.items():
+                if plays != 0:
+                    file.write(
+                        PlayHistory.RECORD.pack(
+                            played, track_id, PlayHistory.PLAY, plays
+                        )
+                    )
+                if skips != 0:
+                    file.write(
+                        PlayHistory.RECORD.pack(
+                            skipped, track_id, PlayHistory.SKIP, skips
+                        )
+                    )
+        self.file.close()
+        os.replace(temporary, self.path)
+        self.file = open(self.path, "ab")
+        self.records = sum(
+            (entry[1] != 0) + (entry[2] != 0) for entry in self.tracks.values()
+        )
 
-        MSVCRT = True
-    except ImportError:
-        MSVCRT = False
+    def factor(self, track_id: int, now: float) -> float:
+        # how likely a drawn track is to be accepted, from 0 right after it played
+        # up to 1 for a track without recent plays or skips
+        entry = self.tracks.get(track_id)
+        if entry is None:
+            return 1.0
+        played, _, skips, skipped = entry
+        recency = (
+            min(max(now - played, 0) / self.recency_window, 1)
+            if self.recency_window > 0
+            else 1
+        )
+        return recency * PlayHistory.SKIP_PENALTY ** self.decayed(skips, skipped, now)
 
+    def stats(self) -> "dict[str, float]":
+        return {
+            "tracks": len(self.tracks),
+            "records": self.records,
+            "plays": sum(entry[1] for entry in self.tracks.values()),
+        }
 
-os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "hide"
-from pygame import mixer
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
 
-try:
-    from mutagen.mp3 import MP3
-except ImportError:
-    print("warning: no mutagen. falling back to ffmpeg for mp3 length detection.")
 
-YOUTUBE_DL_ID_REGEX = re.compile(r"\[[a-zA-Z0-9\-_]{11}]")
-MOVE_AND_CLEAR_LINE = "\x1b[1A\x1b[2K"
-ANSI_REGEX = re.compile("\x1b\\[\\d+?m")
-INFLO_SHARE_URL = "https://inflo-share-server.onrender.com/"
+class WeightedSampler:
+    # alias method table (vose) compiled from the weights file. draws are O(1) and
+    # the table is only rebuilt when the weights file's mtime or the library changes.
+    # with a play history, draws are rejected in proportion to its penalty
+    MAX_REJECTIONS = 16
+    weights_file: "str | None"
+    library: "LibraryIndex"
+    history: "PlayHistory | None"
+    keys: "list[str]"
+    weights: "list[float]"
+    _prob: "list[float]"
+    _alias: "list[int]"
+    _signature: "tuple[int | None, int] | None"
 
+    def __init__(
+        self,
+        weights_file: "str | None",
+        library: "LibraryIndex",
+        history: "PlayHistory | None" = None,
+    ):
+        self.weights_file = weights_file
+        self.library = library
+        self.history = history
+        self.keys = []
+        self.weights = []
+        self._prob = []
+        self._alias = []
+        self._signature = None
 
-class IOUtilities:
-    @staticmethod
-    def generate_weights(weights_file: str):
-        if weights_file is None:
-            return [list(filter(lambda k: k.endswith("mp3"), os.listdir("."))), None]
-        data: "dict[str, str]" = json.load(open(weights_file, encoding="utf8"))
-        # sort data by key length, shortest first. this allows longer completions to override shorter ones
-        data = {k: v for k, v in sorted(data.items(), key=lambda item: len(item[0]))}
+    def signature(self) -> "tuple[int | None, int]":
+        weights_mtime = None
+        if self.weights_file is not None:
+            try:
+                weights_mtime = os.stat(self.weights_file).st_mtime_ns
+            except OSError:
+                pass
+        return weights_mtime, self.library.version
 
-        files = list(filter(lambda k: k.endswith("mp3"), os.listdir(".")))
-        weights = {}
-        for key in data:
-            if not isinstance(data[key], (int, float)):
-                continue
-            if key in files:
-                weights[key] = data[key]
+    def refresh(self) -> bool:
+        signature = self.signature()
+        if signature == self._signature:
+            return False
+        try:
+            self.compile()
+        except (OSError, ValueError, AttributeError):
+            # e.g. caught halfway through a save. the last table is kept and the
+            # signature isn't, so the next change to the file is tried again
+            if self._signature is None:
+                raise
+            return False
+        self._signature = signature
+        return True
+
+    def compile(self) -> None:
+        with METRICS.timed("generate_weights"):
+            keys, weights = IOUtilities.generate_weights(
+                self.weights_file, self.library.files()
+            )
+            keys = list(keys)
+        weights = (
+            [1.0] * len(keys)
+            if weights is None
+            else [max(float(w), 0.0) for w in weights]
+        )
+        total = sum(weights)
+        if total == 0:
+            weights = [1.0] * len(keys)
+            total = float(len(keys))
+        count = len(keys)
+        scaled = [w * count / total for w in weights]
+        prob = [1.0] * count
+        alias = list(range(count))
+        small = [i for i, w in enumerate(scaled) if w < 1]
+        large = [i for i, w in enumerate(scaled) if w >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        self.keys, self.weights, self._prob, self._alias = keys, weights, prob, alias
+
+    def draw(self) -> str:
+        self.refresh()
+        if self.history is None:
+            return self.draw_key()
+        # each attempt is O(1). when every attempt is rejected, e.g. in a library
+        # that all played recently, the least penalised candidate is played
+        now = time.time()
+        best, best_factor = None, -1.0
+        for _ in range(self.MAX_REJECTIONS):
+            key = self.draw_key()
+            track = self.library.tracks.get(key)
+            factor = 1.0 if track is None else self.history.factor(track.id, now)
+            if random.random() < factor:
+                return key
+            if factor > best_factor:
+                best, best_factor = key, factor
+        return best
+
+    def draw_key(self) -> str:
+        idx = int(random.random() * len(self.keys))
+        return (
+            self.keys[idx]
+            if random.random() < self._prob[idx]
+            else self.keys[self._alias[idx]]
+        )
+
+    def probabilities(self) -> "dict[str, float]":
+        # read back from the compiled table, so this is exactly what draw() samples
+        self.refresh()
+        count = len(self.keys)
+        result = [0.0] * count
+        for idx in range(count):
+            result[idx] += self._prob[idx] / count
+            result[self._alias[idx]] += (1 - self._prob[idx]) / count
+        return dict(zip(self.keys, result))
+
+    def draw_indices(self, rng: "numpy.random.Generator", shape) -> "numpy.ndarray":
+        # the same alias table as draw(), sampled many times in one go
+        prob = numpy.asarray(self._prob)
+        alias = numpy.asarray(self._alias)
+        idx = rng.integers(0, len(self.keys), size=shape)
+        return numpy.where(rng.random(shape) < prob[idx], idx, alias[idx])
+
+    def spread(
+        self,
+        rng: "numpy.random.Generator",
+        candidates: "numpy.ndarray",
+        min_distance: int,
+    ) -> "list[int]":
+        # rejects candidates that repeat one of the last min_distance tracks, drawing
+        # more as needed. this plays heavily weighted tracks less often than their
+        # weight, which the simulation shows
+        count = len(candidates)
+        result = []
+        last: "dict[int, int]" = {}
+        while len(result) < count:
+            for idx in candidates.tolist():
+                if len(result) - last.get(idx, -min_distance - 1) > min_distance:
+                    last[idx] = len(result)
+                    result.append(idx)
+                    if len(result) == count:
+                        break
+            candidates = self.draw_indices(rng, count)
+        return result
+
+    def check_distance(self, min_distance: int) -> None:
+        playable = sum(1 for p in self.probabilities().values() if p > 0)
+        if min_distance >= playable:
+            raise ValueError(
+                f"a minimum distance of {min_distance} needs more than {playable} tracks with a weight"
+            )
+
+    def schedule(
+        self, count: int, min_distance: int = 0, seed: "int | None" = None
+    ) -> "list[str]":
+        # count tracks planned ahead, with at least min_distance others between
+        # repeats of the same track
+        self.refresh()
+        self.check_distance(min_distance)
+        rng = numpy.random.default_rng(seed)
+        indices = self.draw_indices(rng, count)
+        if min_distance > 0:
+            indices = self.spread(rng, indices, min_distance)
+        return [self.keys[idx] for idx in indices]
+
+    def simulate(
+        self,
+        hours: float,
+        runs: int,
+        min_distance: int = 0,
+        seed: "int | None" = None,
+    ) -> "dict[str, tuple[float, float, float]]":
+        # monte carlo play counts over hours of listening, using the probed track
+        # lengths. returns the mean, 5th and 95th percentile of plays per track
+        self.refresh()
+        self.check_distance(min_distance)
+        rng = numpy.random.default_rng(seed)
+        count = len(self.keys)
+        lengths = numpy.array(
+            [
+                getattr(self.library.tracks.get(key), "length", None) or 0.0
+                for key in self.keys
+            ],
+            dtype=float,
+        )
+        # unprobed tracks count as an average one, so they can't fill the period
+        known = lengths[lengths > 0]
+        lengths[lengths <= 0] = known.mean() if len(known) != 0 else 180.0
+        probabilities = numpy.fromiter(self.probabilities().values(), float, count)
+        period = hours * 3600
+        per_run = int(period / float(probabilities @ lengths) * 1.2) + 16
+        while True:
+            if min_distance > 0:
+                draws = numpy.array(
+                    [
+                        self.spread(rng, self.draw_indices(rng, per_run), min_distance)
+                        for _ in range(runs)
+                    ]
+                ).reshape(runs, per_run)
             else:
-                autocompletions = list(filter(lambda k: k.startswith(key), files))
-                if len(autocompletions) == 0:
-                    print(f"No such key {key}")
-                for completion in autocompletions:
-                    weights[completion] = data[key]
-        for file in files:
-            if file not in weights:
-                weights[file] = 1
-        return zip(*weights.items())
+                draws = self.draw_indices(rng, (runs, per_run))
+            ends = numpy.cumsum(lengths[draws], axis=1)
+            if (ends[:, -1] >= period).all():
+                break
+            per_run *= 2
+        # a track counts as played when it started within the period
+        played = ends - lengths[draws] < period
+        rows = numpy.repeat(numpy.arange(runs), per_run).reshape(runs, per_run)
+        plays = numpy.bincount(
+            (rows * count + draws)[played], minlength=runs * count
+        ).reshape(runs, count)
+        low, high = numpy.percentile(plays, [5, 95], axis=0)
+        return {
+            key: (float(mean), float(lo), float(hi))
+            for key, mean, lo, hi in zip(self.keys, plays.mean(axis=0), low, high)
+        }
 
-    @staticmethod
-    def setraw():
-        if UNIX_TTY:
-            tty.setraw(sys.stdin.fileno())
-            os.set_blocking(sys.stdin.fileno(), False)
 
-    @staticmethod
-    def unsetraw(normal_tty_settings):
-        if UNIX_TTY:
-            termios.tcsetattr(
-                sys.stdin.fileno(), termios.TCSADRAIN, normal_tty_settings
+class StreamBuffer:
+    # a bounded ring buffer between a producer thread and the mixer, which reads it
+    # like a file. bytes already read stay in the ring until the producer needs the
+    # space, so the decoder can seek back a little while it probes the format.
+    # decoders also look for tags at the end of the file, which a stream doesn't
+    # have yet: seeking relative to the end reports UNKNOWN_SIZE until the stream
+    # has ended, and detaches the buffer, so reads there come back as zeros without
+    # consuming anything until the decoder seeks back into the buffered part
+    READ_TIMEOUT = 5
+    UNKNOWN_SIZE = 2**31 - 1
+    capacity: "int"
+    data: "bytearray"
+    start: "int"
+    size: "int"
+    position: "int"
+    written: "int"
+    eof: "bool"
+    closed: "bool"
+    detached: "int | None"
+    condition: "threading.Condition"
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.data = bytearray(capacity)
+        self.start = self.size = self.position = self.written = 0
+        self.eof = self.closed = False
+        self.detached = None
+        self.condition = threading.Condition()
+
+    def write(self, chunk: bytes) -> bool:
+        # blocks while the ring is full. returns False once the reader is gone
+        view = memoryview(chunk)
+        while len(view) != 0:
+            with self.condition:
+                while self.size == self.capacity and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return False
+                count = min(len(view), self.capacity - self.size)
+                end = (self.start + self.size) % self.capacity
+                first = min(count, self.capacity - end)
+                self.data[end : end + first] = view[:first]
+                self.data[: count - first] = view[first:count]
+                self.size += count
+                self.written += count
+                self.condition.notify_all()
+            view = view[count:]
+        return True
+
+    def finish(self) -> None:
+        with self.condition:
+            self.eof = True
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def fill(self) -> float:
+        return self.size / self.capacity
+
+    def read(self, count: int = -1) -> bytes:
+        with self.condition:
+            if self.detached is not None:
+                # short reads look like a corrupt file to the decoder, zeros like
+                # a file without tags
+                count = max(min(count, StreamBuffer.UNKNOWN_SIZE - self.detached), 0)
+                self.detached += count
+                return bytes(count)
+            # an underrun pauses playback before it gets here, so this only waits
+            # when the decoder reads ahead
+            self.condition.wait_for(
+                lambda: self.size != 0 or self.eof or self.closed,
+                StreamBuffer.READ_TIMEOUT,
+            )
+            count = self.size if count < 0 else min(count, self.size)
+            first = min(count, self.capacity - self.start)
+            chunk = bytes(self.data[self.start : self.start + first]) + bytes(
+                self.data[: count - first]
             )
+            self.start = (self.start + count) % self.capacity
+            self.size -= count
+            self.position += count
+            self.condition.notify_all()
+            return chunk
 
-    @staticmethod
-    def term_length(string: str) -> int:
-        string = ANSI_REGEX.sub("", string).replace("\n", "")
-        length = 0
-        for char in string:
-            length += 2 if unicodedata.east_asian_width(char) in ["W", "F"] else 1
-        return length
+    def tell(self) -> int:
+        return self.position if self.detached is None else self.detached
 
-    @staticmethod
-    @functools.cache
-    def process_name(name: str) -> "list[str]":
-        length = IOUtilities.term_length(name)
-        if length < 60:
-            cur_len, idx = 0, 0
-            cur = ""
-            while cur_len < length / 2:
-                cur += name[idx]
-                cur_len += IOUtilities.term_length(name[idx])
-                idx += 1
-            return [cur, name[idx:]]
-        lines = []
-        cur = ""
-        cur_len = 0
-        idx = 0
-        while idx < len(name):
-            while cur_len < 30 and idx < len(name):
-                cur += name[idx]  # TODO: use graphemes instead
-                cur_len += IOUtilities.term_length(name[idx])
-                idx += 1
-            lines.append(cur)
-            cur = ""
-            cur_len = 0
-        return lines
+    def seekable(self) -> bool:
+        return True
 
-    @staticmethod
-    @functools.cache
-    def normalize(text: str) -> str:
-        return unicodedata.normalize("NFC", text)
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        with self.condition:
+            if whence == os.SEEK_CUR:
+                offset += self.tell()
+            elif whence == os.SEEK_END:
+                offset += self.written if self.eof else StreamBuffer.UNKNOWN_SIZE
+                self.detached = offset
+                return offset
+            history = min(self.position, self.capacity - self.size)
+            if offset < self.position - history:
+                raise OSError("can only seek back within the buffered part of a stream")
+            if offset - self.position > self.capacity or (
+                self.detached is not None and offset > self.position
+            ):
+                # further than the ring can hold, so the decoder is looking around
+                # the end. moving back reattaches
+                self.detached = offset
+                return offset
+            self.detached = None
+            # skipping ahead waits for the bytes to arrive, like a read does
+            self.condition.wait_for(
+                lambda: offset <= self.position + self.size or self.eof or self.closed,
+                StreamBuffer.READ_TIMEOUT,
+            )
+            offset = min(offset, self.position + self.size)
+            moved = offset - self.position
+            self.start = (self.start + moved) % self.capacity
+            self.size -= moved
+            self.position = offset
+            self.condition.notify_all()
+            return offset
 
-    @staticmethod
-    def getch():
-        if UNIX_TTY or MSVCRT:
-            if UNIX_TTY:
-                c = sys.stdin.read(1)
-            else:
-                c = msvcrt.getwch() if msvcrt.kbhit() else ""
-            if c == "\x03":
-                raise KeyboardInterrupt()
-            return c
-        else:
-            return ""
 
-    @staticmethod
-    def get_length(music: str) -> float:
-        try:
-            return MP3(music).info.length
-        except Exception:
+class StreamSource:
+    # fills a StreamBuffer from an http(s) url or a local file that may still be
+    # growing, on its own thread. http streams reconnect with backoff, resuming at
+    # the same byte when the server supports ranges; a file counts as complete
+    # once it hasn't grown for IDLE_TIMEOUT seconds
+    CHUNK = 16 * 1024
+    # below this many buffered bytes playback pauses until the prefetch refills
+    LOW_WATER = 4 * 1024
+    IDLE_TIMEOUT = 10
+    MAX_BACKOFF = 30
+    # the mixer can't sniff the format of a file object, so it's given a hint
+    FORMATS = {
+        "audio/mpeg": "mp3",
+        "audio/ogg": "ogg",
+        "application/ogg": "ogg",
+        "audio/flac": "flac",
+        "audio/wav": "wav",
+        "audio/x-wav": "wav",
+    }
+    location: "str"
+    buffer: "StreamBuffer"
+    name: "str"
+    format: "str"
+    reconnects: "int"
+    running: "bool"
+
+    def __init__(self, location: str, capacity: int):
+        self.location = location
+        self.buffer = StreamBuffer(capacity)
+        self.name = os.path.basename(location.rstrip("/")) or location
+        extension = os.path.splitext(location.split("?")[0])[1][1:].lower()
+        self.format = extension if extension in self.FORMATS.values() else "mp3"
+        self.reconnects = 0
+        self.running = True
+
+    def start(self) -> None:
+        target = (
+            self.fetch
+            if self.location.startswith(("http://", "https://"))
+            else self.follow
+        )
+        threading.Thread(target=target, name="inflo-stream", daemon=True).start()
+
+    def fetch(self) -> None:
+        attempts = 0
+        ranges = False
+        while self.running:
+            headers = {}
+            if ranges and self.buffer.written != 0:
+                headers["Range"] = f"bytes={self.buffer.written}-"
             try:
-                return float(
-                    subprocess.check_output(
-                        [
-                            "ffprobe",
-                            "-i",
-                            music,
-                            "-show_entries",
-                            "format=duration",
-                            "-v",
-                            "quiet",
-                            "-of",
-                            'csv="p=0"',
-                        ]
+                with requests.get(
+                    self.location, stream=True, headers=headers, timeout=NETWORK_TIMEOUT
+                ) as response:
+                    if response.status_code == 416:
+                        # resumed exactly at the end
+                        break
+                    response.raise_for_status()
+                    ranges = response.headers.get("Accept-Ranges") == "bytes"
+                    self.name = response.headers.get("icy-name") or self.name
+                    content_type = response.headers.get("Content-Type", "")
+                    self.format = StreamSource.FORMATS.get(
+                        content_type.split(";")[0].strip(), self.format
                     )
-                )
+                    # a server that ignored the range starts over from the beginning
+                    skip = self.buffer.written if "Range" in headers else 0
+                    if response.status_code == 206:
+                        skip = 0
+                    before, received = self.buffer.written, 0
+                    for chunk in response.iter_content(StreamSource.CHUNK):
+                        attempts = 0
+                        received += len(chunk)
+                        if skip != 0:
+                            chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                        if not self.buffer.write(chunk):
+                            return
+                    length = response.headers.get("Content-Length")
+                    if self.buffer.written == before or (
+                        length is not None and received >= int(length)
+                    ):
+                        break
+                # a live stream has no length and doesn't end, so the connection
+                # closing early is a drop like any other
+                raise ConnectionError("the stream closed early")
             except Exception:
-                print("warning: ffmpeg failed. setting length to 0")
-                return 0
+                if not self.running:
+                    return
+                attempts += 1
+                self.reconnects += 1
+                time.sleep(min(2**attempts, StreamSource.MAX_BACKOFF))
+        self.buffer.finish()
+
+    def follow(self) -> None:
+        try:
+            with open(self.location, "rb") as file:
+                idle = time.monotonic()
+                while self.running:
+                    chunk = file.read(StreamSource.CHUNK)
+                    if chunk:
+                        idle = time.monotonic()
+                        if not self.buffer.write(chunk):
+                            return
+                    elif time.monotonic() - idle > StreamSource.IDLE_TIMEOUT:
+                        break
+                    else:
+                        time.sleep(0.2)
+        except OSError:
+            pass
+        self.buffer.finish()
+
+    def close(self) -> None:
+        self.running = False
+        self.buffer.close()
 
 
 class MusicPlayer:
-    presence: "pypresence.Presence | None"
+    # how long before a track ends the next one is picked, probed and queued
+    PRELOAD_AHEAD = 10
+    # how often the end of a track whose length is unknown is checked for
+    UNKNOWN_LENGTH_POLL = 0.5
+    enable_discord: "bool"
     normal_tty_settings: "list[Any]" = None
     diff: "tuple[float, float] | None"
     playing: "bool"
-    presence_update_lock: "threading.Lock"
+    worker: "BackgroundWorker"
+    publisher: "PresencePublisher"
+    metadata: "tuple[str, str, str | None] | None"
+    share: "ShareClient | None"
+    share_url: "str"
     weights_file: "str"
+    library: "LibraryIndex"
+    metadata_cache: "MetadataCache | None"
+    sampler: "WeightedSampler"
+    search: "SearchIndex"
     length: "float"
     volume: "float"
     queue: "list[str]"
-    lines_written: "list[str] | None"
+    renderer: "TerminalRenderer | None"
+    control_socket: "str | None"
+    control: "ControlServer | None"
     queue_content: "str"
     auto: "str"
     is_queueing: "bool"
+    name: "str"
+    youtube_id: "str | None"
+    input: "InputWaiter"
+    fps: "float"
+    report_wakeups: "bool"
+    presence_stats: "bool"
+    wakeup_rate: "float"
+    wakeups: "int"
+    wakeup_window: "float"
+    next_render: "float"
+    next_presence: "float"
+    next_share: "float"
+    show_metrics: "bool"
+    metrics_log: "str | None"
+    metrics_interval: "float"
+    metrics_file: "Any"
+    next_metrics: "float"
+    crossfade: "float"
+    preload_budget: "int"
+    track: "Track | None"
+    upcoming: "Track | None"
+    upcoming_from: "str"
+    pos_offset: "float"
+    last_raw: "float"
+    tail: "tuple[str, float, bytes] | None"
+    tail_channel: "mixer.Channel | None"
+    normalize_loudness: "bool"
+    gain: "float"
+    tail_gain: "float"
+    stream: "str | None"
+    stream_buffer: "int"
+    stream_prefetch: "int"
+    source: "StreamSource | None"
+    buffering: "bool"
+    underruns: "int"
+    stream_started: "bool"
+    stream_error: "str | None"
+    schedule: "collections.deque[str]"
+    history: "PlayHistory | None"
 
     def __init__(
         self,
-        presence: "pypresence.Presence | None",
+        enable_discord: "bool",
         initial: "str | None",
         weights_file: "str",
-        disable_api: "bool",
+        metadata_cache: "MetadataCache | None",
         enable_share: "bool",
+        library: "LibraryIndex",
+        share_url: "str" = INFLO_SHARE_URL,
+        fps: "float" = 1,
+        report_wakeups: "bool" = False,
+        presence_stats: "bool" = False,
+        control_socket: "str | None" = None,
+        metrics_log: "str | None" = None,
+        metrics_interval: "float" = 10,
+        crossfade: "float" = 0,
+        preload_budget: "int" = 128 * 1024 * 1024,
+        normalize_loudness: "bool" = False,
+        stream: "str | None" = None,
+        stream_buffer: "int" = 1024 * 1024,
+        stream_prefetch: "int" = 64 * 1024,
+        schedule: "list[str] | None" = None,
+        history: "PlayHistory | None" = None,
     ):
-        self.presence = presence
-        self.disable_api = disable_api
+        self.enable_discord = enable_discord
+        # with a control socket the player runs headless, without touching the terminal
+        self.control_socket = control_socket
+        self.control = None
+        self.library = library
+        # plays and skips survive restarts and steer the sampler away from tracks
+        # that just played or keep getting skipped
+        self.history = history
+        self.sampler = WeightedSampler(weights_file, library, history)
+        self.search = SearchIndex(library)
+        self.fps = fps
+        self.report_wakeups = report_wakeups
+        self.presence_stats = presence_stats
+        self.metadata_cache = metadata_cache
         self.weights_file = weights_file
         self.queue = [initial] if initial is not None else []
         self.enable_share = enable_share
+        self.share_url = share_url
+        self.show_metrics = False
+        self.metrics_log = metrics_log
+        self.metrics_interval = metrics_interval
+        self.metrics_file = None
+        self.next_metrics = math.inf
+        # 0 plays gaplessly, otherwise tracks overlap by this many seconds
+        self.crossfade = crossfade
+        self.preload_budget = preload_budget
+        self.track = None
+        self.upcoming = None
+        # "queue", "schedule" or "sampler"
+        self.upcoming_from = "sampler"
+        self.pos_offset = self.last_raw = 0.0
+        self.tail = None
+        self.tail_channel = None
+        # the current track's loudness correction, multiplied into the volume
+        self.normalize_loudness = normalize_loudness
+        self.gain = self.tail_gain = 1.0
+        # an http stream or a growing file played before the library, through a
+        # ring buffer. playback starts once stream_prefetch bytes are buffered
+        self.stream = stream
+        self.stream_buffer = stream_buffer
+        self.stream_prefetch = min(stream_prefetch, stream_buffer)
+        self.source = None
+        self.buffering = False
+        self.underruns = 0
+        self.stream_started = False
+        self.stream_error = None
+        # planned ahead by generate_weights.py, played after the queue and before
+        # falling back to the sampler
+        self.schedule = collections.deque(schedule or [])
 
     def start(self) -> None:
-        requests_cache.install_cache("inflo_cache", backend="memory", expire_after=3600)
         self.queue_content = ""
         self.auto = ""
         self.is_queueing = False
-        self.lines_written = None
-        self.presence_update_lock = threading.Lock()
+        self.worker = BackgroundWorker()
+        atexit.register(self.worker.close)
+        self.publisher = PresencePublisher(None, self.worker)
+        self.metadata = None
+        self.share = (
+            ShareClient(self.worker, self.share_url) if self.enable_share else None
+        )
         self.volume = 1.0
-        if UNIX_TTY:
-            self.normal_tty_settings = termios.tcgetattr(sys.stdin.fileno())
-            atexit.register(IOUtilities.unsetraw, self.normal_tty_settings)
-        IOUtilities.setraw()
+        self.wakeup_rate = 0.0
+        if self.control_socket is not None:
+            self.input = InputWaiter(stdin=False)
+            self.renderer = None
+            self.control = ControlServer(self.control_socket, self.input)
+            atexit.register(self.control.close)
+        else:
+            if UNIX_TTY:
+                self.normal_tty_settings = termios.tcgetattr(sys.stdin.fileno())
+                atexit.register(IOUtilities.unsetraw, self.normal_tty_settings)
+            IOUtilities.setraw()
+            self.input = InputWaiter()
+            self.renderer = TerminalRenderer(self.input)
+        if self.metrics_log is not None:
+            # one json object per line, appended to across runs
+            self.metrics_file = open(self.metrics_log, "a", encoding="utf8")
+            atexit.register(self.metrics_file.close)
+            self.next_metrics = time.monotonic() + self.metrics_interval
         mixer.init()
-        if self.presence is not None:
-            atexit.register(self.presence.close)
-        if self.enable_share:
-            share = requests.post(INFLO_SHARE_URL + "start").json()
-            self.secret: str = share["secret"]
-            self.share_id: str = share["id"]
+        TIMINGS.mark("mixer initialised")
+        atexit.register(self.publisher.close)
+        if self.enable_discord:
+            # connects on the worker while the first song starts; queued ahead of
+            # the first presence update
+            self.worker.submit("presence-reload", self.publisher.connect)
         self.run()
 
     def run(self):
+        if self.stream is not None:
+            self.play_stream(self.stream)
         while True:
-            if len(self.queue) != 0:
-                self.play(self.queue[0])
-                self.queue.pop(0)
+            if self.upcoming is not None:
+                # preloaded, but the track before it was skipped
+                song, self.upcoming = self.upcoming.path, None
             else:
-                keys, weights = IOUtilities.generate_weights(self.weights_file)
-                self.play(random.choices(keys, weights)[0])
+                song, _ = self.next_song()
+            self.play(song)
 
-    def update(self, *args, **kwargs):
-        with contextlib.redirect_stderr(None), contextlib.redirect_stderr(
-            None
-        ), self.presence_update_lock:
-            if self.presence is not None:
-                buttons = [
+    def next_song(self) -> "tuple[str, str]":
+        # the song and where it came from
+        if len(self.queue) != 0:
+            return self.queue.pop(0), "queue"
+        if len(self.schedule) != 0:
+            return self.schedule.popleft(), "schedule"
+        # picks up library changes for the songs after this one, without blocking
+        self.library.start_scan()
+        return self.sampler.draw(), "sampler"
+
+    def enqueue(self, song: str) -> None:
+        self.queue.append(song)
+        if self.upcoming is not None and self.upcoming_from != "queue":
+            # a drawn song was already queued in the mixer, the queue goes first
+            if self.upcoming_from == "schedule":
+                self.schedule.appendleft(self.upcoming.path)
+            self.upcoming = None
+
+    def update(self, **kwargs):
+        # the metadata lookup and the presence update itself run on the worker
+        self.worker.submit("presence", self.publish_presence, **kwargs)
+
+    def lookup_metadata(self, video_id: str) -> "tuple[str, str | None]":
+        # only looked up again once the video changes
+        if self.metadata is not None and self.metadata[0] == video_id:
+            return self.metadata[1], self.metadata[2]
+        fallback = f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg", None
+        if self.metadata_cache is None:
+            return fallback
+        try:
+            with METRICS.timed("metadata_lookup"):
+                large_image_url, channel_name = self.metadata_cache.lookup(
+                    video_id, self.worker.session
+                )
+        except Exception:
+            # not remembered, so the next update tries the api again
+            return fallback
+        self.metadata = (video_id, large_image_url, channel_name)
+        return large_image_url, channel_name
+
+    def publish_presence(self, **kwargs):
+        if self.publisher.presence is None:
+            return
+        buttons = [
+            {
+                "label": "Source code",
+                "url": "https://github.com/pandaninjas/Inflo",
+            }
+        ]
+        match = YOUTUBE_DL_ID_REGEX.search(kwargs["name"])
+        name = kwargs.pop("name", "")
+        details = kwargs.pop("details", "")
+        processed_name = IOUtilities.process_name(name)
+        if not match:
+            return
+        video_id = match.group(0).strip("[]")
+        large_image_url, channel_name = self.lookup_metadata(video_id)
+        if self.share is None or self.share.share_id is None:
+            if "end" in kwargs:
+                buttons.append(
                     {
-                        "label": "Source code",
-                        "url": "https://github.com/pandaninjas/Inflo",
+                        "label": "Join",
+                        "url": f"https://youtube.com/watch?v={video_id}&t={round(self.length - (kwargs['end'] - time.time()))}",
                     }
-                ]
-                match = YOUTUBE_DL_ID_REGEX.search(kwargs["name"])
-                name = kwargs.pop("name", "")
-                details = kwargs.pop("details", "")
-                processed_name = IOUtilities.process_name(name)
-                large_image_url = None
-                channel_name = None
-                if match:
-                    video_id = match.group(0).strip("[]")
-                    if self.disable_api:
-                        large_image_url = (
-                            f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg"
-                        )
-                        channel_name = None
-                    else:
-                        try:
-                            api_result = requests.get(
-                                "https://inflo-api.thefightagainstmalware.workers.dev/"
-                                + video_id,
-                                timeout=1,
-                            ).json()
-                            large_image_url = api_result["maxres"]
-                            channel_name = api_result["channelTitle"]
-                        except Exception:
-                            large_image_url = f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg"
-                            channel_name = None
-                    if not self.enable_share:
-                        if "end" in kwargs:
-                            buttons.append(
-                                {
-                                    "label": "Join",
-                                    "url": f"https://youtube.com/watch?v={video_id}&t={round(self.length - (kwargs['end'] - time.time()))}",
-                                }
-                            )
-                        else:
-                            buttons.append(
-                                {
-                                    "label": "Join",
-                                    "url": f"https://youtube.com/watch?v={video_id}",
-                                }
-                            )
-                    else:
-                        buttons.append(
-                            {
-                                "label": "Join",
-                                "url": f"{INFLO_SHARE_URL}{self.share_id}",
-                            }
-                        )
-                    try:
-                        self.presence.update(
-                            *args,
-                            **kwargs,
-                            large_image=large_image_url,
-                            buttons=buttons,
-                            large_text=channel_name,
-                            instance=False,
-                            details=details + processed_name[0].strip(),
-                            state="".join(processed_name[1:]).strip(),
-                        )
-                    except Exception as e:
-                        if isinstance(e, pypresence.PipeClosed):
-                            self.queue_thread(self.reload_presence)
-                            return
-                        try:
-                            self.presence.close()
-                        except Exception:
-                            pass
-                        self.presence = None
+                )
+            else:
+                buttons.append(
+                    {
+                        "label": "Join",
+                        "url": f"https://youtube.com/watch?v={video_id}",
+                    }
+                )
+        else:
+            buttons.append(
+                {
+                    "label": "Join",
+                    "url": f"{self.share.url}{self.share.share_id}",
+                }
+            )
+        self.publisher.publish(
+            {
+                **kwargs,
+                "large_image": large_image_url,
+                "buttons": buttons,
+                "large_text": channel_name,
+                "instance": False,
+                "details": details + processed_name[0].strip(),
+                "state": "".join(processed_name[1:]).strip(),
+            }
+        )
 
     def reload_presence(self):
-        with contextlib.redirect_stderr(None), contextlib.redirect_stderr(None):
-            try:
-                self.presence.close()
-            except Exception:
-                pass
-            try:
-                self.presence = pypresence.Presence("1033827079994753064")
-                self.presence.connect()
-            except Exception:
-                pass
+        self.publisher.reconnect_attempts = 0
+        self.publisher.reconnect()
 
     def render_progress_bar(self) -> str:
+        if self.source is not None:
+            return self.render_buffer_bar()
         start = self.get_start()
         end = self.get_end()
         cur_time = time.time()
@@ -306,191 +2954,552 @@ class MusicPlayer:
         mins_end, secs_end = divmod(end - cur_time, 60)
         left_timer = f"{int(mins_start)}:{int(secs_start):02d} "
         right_timer = f" -{int(mins_end)}:{int(secs_end):02d}"
-        bar_width = os.get_terminal_size().columns - len(left_timer) - len(right_timer)
+        bar_width = self.renderer.columns - len(left_timer) - len(right_timer)
+        if self.length <= 0:
+            # unknown length, only the elapsed time is shown
+            right_timer = " -?:??"
+            bar_width = self.renderer.columns - len(left_timer) - len(right_timer)
+            return f"{left_timer}{bar_width * '━'}{right_timer}"
         left_bar_width = int(min((cur_time - start) / (end - start), 1) * bar_width)
         right_bar_width = bar_width - left_bar_width
         return f"{left_timer}\x1b[32m{left_bar_width * '━'}\x1b[0m{right_bar_width * '━'}{right_timer}"
 
-    def update_share(self, youtube_id: str, progress: float, playing: bool):
-        if not self.enable_share:
-            return
-        try:
-            r = requests.put(
-                INFLO_SHARE_URL + "update/" + self.secret,
-                json={"playing": playing, "id": youtube_id, "progress": progress},
-            ).json()
-            if r["status"] == "fail":
-                share = requests.post(INFLO_SHARE_URL + "start").json()
-                self.secret: str = share["secret"]
-                self.share_id: str = share["id"]
-        except Exception:
-            return
+    def render_buffer_bar(self) -> str:
+        # a stream has no end, so the bar shows how full the buffer is instead
+        fill = self.source.buffer.fill()
+        mins, secs = divmod(self.position(), 60)
+        left_timer = f"{int(mins)}:{int(secs):02d} "
+        right_label = " buffering" if self.buffering else f" {fill:4.0%} buffered"
+        bar_width = self.renderer.columns - len(left_timer) - len(right_label)
+        left_bar_width = int(min(fill, 1) * bar_width)
+        right_bar_width = bar_width - left_bar_width
+        return f"{left_timer}\x1b[36m{left_bar_width * '━'}\x1b[0m{right_bar_width * '━'}{right_label}"
+
+    def sync_share(self) -> None:
+        # progress comes from the mixer clock, so the share follows pauses exactly
+        if self.share is not None:
+            self.share.push(self.youtube_id, self.position(), self.playing)
+        self.next_share = time.monotonic() + ShareClient.RESYNC_INTERVAL
+
+    def position(self) -> float:
+        # the mixer clock keeps running across queued tracks in some pygame versions,
+        # so it's offset by the tracks that already ended
+        return max(mixer.music.get_pos(), 0) / 1000 - self.pos_offset
 
     def get_start(self):
-        return time.time() - (mixer.music.get_pos() / 1000)
+        return time.time() - self.position()
 
     def get_end(self):
-        return time.time() + self.length - (mixer.music.get_pos() / 1000)
+        return time.time() + self.length - self.position()
 
-    def queue_thread(self, *args):
-        threading.Thread(target=args[0], args=args[1:]).start()
+    def apply_volume(self) -> None:
+        mixer.music.set_volume(self.volume * self.gain)
+        if self.tail_channel is not None:
+            self.tail_channel.set_volume(self.volume * self.tail_gain)
 
     def autocomplete(self):
-        files = sorted(
-            filter(
-                lambda file: file.startswith(self.auto if self.auto != "" else self.queue_content) and file.endswith(".mp3"),
-                os.listdir("."),
-            )
-        )
-
-        if len(files) == 0:
-            return
         if self.auto != "":
             # get next autocomplete
-            idx = bisect.bisect(files, self.queue_content) % len(files)
-            self.queue_content = files[idx]
+            completion = self.search.cycle(self.auto, self.queue_content)
         else:
+            completion = self.search.cycle(self.queue_content, None)
+        if completion is None:
+            return
+        if self.auto == "":
             self.auto = self.queue_content
-            self.queue_content = files[0]
+        self.queue_content = completion
 
-    def play(self, song: str) -> None:
-        name = song.replace(".mp3", "").strip()
-        self.length = IOUtilities.get_length(song)
-        self.playing = True
-        self.update(name=name, start=time.time(), end=time.time() + self.length)
-        youtube_id = YOUTUBE_DL_ID_REGEX.search(name).group(0).strip("[]")
-        self.queue_thread(self.update_share, youtube_id, 0, True)
-        count = 0
-        mixer.music.load(song)
-        mixer.music.play()
-        while mixer.music.get_busy() or not self.playing:
-            c = IOUtilities.getch()
-            if self.is_queueing:
-                if c == "\x1b":  # escape key
-                    self.is_queueing = False
-                    self.queue_content = ""
-                    self.auto = ""
-                elif c == "\x08":  # backspace
-                    self.queue_content = self.queue_content[:-1]
-                    self.auto = ""
-                elif c == "\t":  # tab
-                    self.autocomplete()
-                elif c == "\r":
-                    self.queue.append(
-                        next(
-                            filter(
-                                lambda file: file.startswith(self.queue_content)
-                                and file.endswith(".mp3"),
-                                os.listdir("."),
-                            )
-                        )
+    def handle_key(self, c: str) -> bool:
+        # returns True when the current song should be skipped
+        name = self.name
+        if self.is_queueing:
+            if c == "\x1b":  # escape key
+                self.is_queueing = False
+                self.queue_content = ""
+                self.auto = ""
+            elif c in ("\x08", "\x7f"):  # backspace
+                self.queue_content = self.queue_content[:-1]
+                self.auto = ""
+            elif c == "\t":  # tab
+                self.autocomplete()
+            elif c == "\r":
+                song = self.search.resolve(self.queue_content)
+                if song is not None:
+                    self.enqueue(song)
+                self.auto = ""
+                self.is_queueing = False
+                self.queue_content = ""
+            elif c != "":
+                self.queue_content += c
+                self.auto = ""
+        else:
+            if c == "s":
+                self.record_skip()
+                return True
+            elif c == "r":
+                self.worker.submit("presence-reload", self.reload_presence)
+                if self.playing:
+                    self.update(name=name, start=self.get_start(), end=self.get_end())
+                else:
+                    self.update(
+                        name="Paused: " + name,
+                        start=time.time(),
                     )
-                    self.auto = ""
-                    self.is_queueing = False
-                    self.queue_content = ""
-                elif c != "":
-                    self.queue_content += c
-                    self.auto = ""
-            else:
-                if c == "s":
-                    print()
-                    return
-                elif c == "r":
-                    with self.presence_update_lock:
-                        self.queue_thread(self.reload_presence)
-                    if self.playing:
-                        self.update(
-                            name=name, start=self.get_start(), end=self.get_end()
-                        )
-                    else:
+            elif c == "p":
+                if self.playing:
+                    mixer.music.pause()
+                    if self.tail_channel is not None:
+                        self.tail_channel.pause()
+                    self.playing = False
+                    self.sync_share()
+                    if self.publisher.presence is not None:
                         self.update(
                             name="Paused: " + name,
                             start=time.time(),
                         )
-                elif c == "p":
-                    if self.playing:
-                        self.queue_thread(
-                            self.update_share,
-                            youtube_id,
-                            mixer.music.get_pos() / 1000,
-                            False,
-                        )
-                        mixer.music.pause()
-                        self.playing = False
-                        if self.presence is not None:
-                            self.update(
-                                name="Paused: " + name,
-                                start=time.time(),
-                            )
-                    else:
+                else:
+                    if not self.buffering:
                         mixer.music.unpause()
-                        self.queue_thread(
-                            self.update_share,
-                            youtube_id,
-                            mixer.music.get_pos() / 1000,
-                            True,
-                        )
-                        self.playing = True
-                        self.update(
-                            name=name, start=self.get_start(), end=self.get_end()
-                        )
-                elif c == "u":
-                    self.volume += 0.01
-                    self.volume = min(1, self.volume)
-                    mixer.music.set_volume(self.volume)
-                elif c == "d":
-                    self.volume -= 0.01
-                    self.volume = max(0, self.volume)
-                    mixer.music.set_volume(self.volume)
-                elif c == "q":
-                    self.is_queueing = True
-                # x1b for ESC
-            controls = (
-                "controls: [s]kip, [r]eload presence, [p]ause, volume [u]p, volume [d]own, [q]ueue mode"
-                if not self.is_queueing
-                else "enter to submit, tab to autocomplete, esc to leave"
-            )
-            if self.playing:
-                IOUtilities.unsetraw(self.normal_tty_settings)
-                if count % 1500 == 0:
+                    if self.tail_channel is not None:
+                        self.tail_channel.unpause()
+                    self.playing = True
+                    self.sync_share()
                     self.update(name=name, start=self.get_start(), end=self.get_end())
-                to_print = f"Now playing {IOUtilities.normalize(name)}\n{self.render_progress_bar()}\n{controls}\nvolume: {self.volume:.2f}\n{self.queue_content}"
-                print(
-                    f"\x1b[2K\r{MOVE_AND_CLEAR_LINE * (self.calculate_lines_written() - 1)}{to_print}\r",
-                    end="",
-                )
-                self.lines_written = to_print.split("\n")
-                IOUtilities.setraw()
-            else:
-                IOUtilities.unsetraw(self.normal_tty_settings)
-                to_print = f"\rPaused: {IOUtilities.normalize(name)}\n{self.render_progress_bar()}\n{controls}\nvolume: {self.volume:.2f}\n{self.queue_content}"
-                print(
-                    f"\x1b[2K\r{MOVE_AND_CLEAR_LINE * (self.calculate_lines_written() - 1)}{IOUtilities.normalize(to_print)}\r",
-                    end="",
-                )
-                self.lines_written = to_print.split("\n")
-                IOUtilities.setraw()
-            count += 1
-            time.sleep(0.01)
-        print()
-
-    def calculate_lines_written(self) -> int:
-        if self.lines_written == None:
-            return 3
-        return sum(
-            map(
-                lambda k: self.ceil(
-                    IOUtilities.term_length(k) / os.get_terminal_size().columns
+            elif c == "u":
+                self.volume += 0.01
+                self.volume = min(1, self.volume)
+                self.apply_volume()
+            elif c == "d":
+                self.volume -= 0.01
+                self.volume = max(0, self.volume)
+                self.apply_volume()
+            elif c == "q":
+                self.is_queueing = True
+            elif c == "m":
+                self.show_metrics = not self.show_metrics
+            # x1b for ESC
+        return False
+
+    def handle_command(self, request: dict) -> "tuple[dict, bool]":
+        # the socket equivalent of handle_key. returns the response and whether
+        # the current song should be skipped
+        command = request.get("command")
+        if command == "skip":
+            self.record_skip()
+            return {"ok": True}, True
+        elif command in ("pause", "resume", "toggle"):
+            if command == "toggle" or self.playing == (command == "pause"):
+                self.handle_key("p")
+            return {"ok": True, "playing": self.playing}, False
+        elif command == "volume":
+            value, delta = request.get("value"), request.get("delta", 0)
+            number = delta if value is None else value
+            if (
+                not isinstance(number, (int, float))
+                or isinstance(number, bool)
+                or not math.isfinite(number)
+            ):
+                return {"ok": False, "error": "volume must be a number"}, False
+            if value is None:
+                value = self.volume + delta
+            self.volume = min(max(float(value), 0), 1)
+            self.apply_volume()
+            return {"ok": True, "volume": self.volume}, False
+        elif command == "queue":
+            song = self.search.resolve(str(request.get("song", "")))
+            if song is None:
+                return {"ok": False, "error": "no matching song"}, False
+            self.enqueue(song)
+            return {"ok": True, "queued": song, "queue": self.queue}, False
+        elif command == "reload":
+            self.handle_key("r")
+            return {"ok": True}, False
+        elif command == "metrics":
+            return {"ok": True, **METRICS.snapshot()}, False
+        elif command == "status":
+            return {
+                "ok": True,
+                "name": self.name,
+                "youtube_id": self.youtube_id,
+                "playing": self.playing,
+                "position": self.position(),
+                "length": self.length if math.isfinite(self.length) else None,
+                "volume": self.volume,
+                "gain": self.gain,
+                "queue": self.queue,
+                "scheduled": len(self.schedule),
+                "history": None if self.history is None else self.history.stats(),
+                "stream": None if self.source is None else self.stream_status(),
+                "stream_error": self.stream_error,
+                "tracks": len(self.library.tracks),
+                "share": (
+                    None
+                    if self.share is None
+                    else {"id": self.share.share_id, "stats": self.share.stats()}
                 ),
-                self.lines_written,
+            }, False
+        return {"ok": False, "error": f"unknown command {command!r}"}, False
+
+    def stream_status(self) -> dict:
+        buffer = self.source.buffer
+        return {
+            "location": self.source.location,
+            "buffered": buffer.size,
+            "capacity": buffer.capacity,
+            "received": buffer.written,
+            "buffering": self.buffering,
+            "underruns": self.underruns,
+            "reconnects": self.source.reconnects,
+            "finished": buffer.eof,
+        }
+
+    def record_skip(self) -> None:
+        # skipping during the last seconds doesn't say much about the track, unless
+        # that's all of it or its length is unknown
+        if self.history is None or self.track is None:
+            return
+        if (
+            self.length <= self.PRELOAD_AHEAD
+            or self.position() < self.length - self.PRELOAD_AHEAD
+        ):
+            self.history.record(self.track.id, PlayHistory.SKIP)
+
+    def render(self) -> None:
+        controls = (
+            "controls: [s]kip, [r]eload presence, [p]ause, volume [u]p, volume [d]own, [q]ueue mode, [m]etrics"
+            if not self.is_queueing
+            else "enter to submit, tab to autocomplete, esc to leave"
+        )
+        status = f"volume: {self.volume:.2f}"
+        if self.gain != 1:
+            status += f" (gain {20 * math.log10(max(self.gain, 1e-5)):+.1f} dB)"
+        if self.report_wakeups:
+            status += f", wakeups/s: {self.wakeup_rate:.1f}"
+        if self.presence_stats:
+            status += f", {self.publisher.stats()}"
+            if self.share is not None:
+                status += f", {self.share.stats()}"
+        if len(self.schedule) != 0:
+            status += f", scheduled: {len(self.schedule)}"
+        if self.source is not None and self.underruns != 0:
+            status += f", underruns: {self.underruns}"
+        progress = self.library.progress()
+        if progress is not None:
+            status += f", {progress}"
+        warning = METRICS.warning()
+        if warning is not None:
+            status += f", {warning}"
+        self.renderer.refresh_geometry()
+        self.renderer.draw(
+            [
+                f"{'Now playing' if self.playing else 'Paused:'} {self.name}",
+                self.render_progress_bar(),
+                controls,
+                status,
+                *(METRICS.status() if self.show_metrics else []),
+                IOUtilities.normalize(self.queue_content),
+            ]
+        )
+
+    def play(self, song: str) -> None:
+        track = self.library.get(song)
+        if track is None:
+            # removed since it was indexed
+            return
+        if self.tail_channel is not None:
+            self.tail_channel.stop()
+            self.tail_channel = None
+        # loading drops whatever was still queued in the mixer
+        mixer.music.load(song)
+        mixer.music.play()
+        TIMINGS.mark("first audio")
+        self.pos_offset = self.last_raw = 0.0
+        self.begin(track)
+        self.loop()
+
+    def play_stream(self, location: str) -> None:
+        self.source = StreamSource(location, self.stream_buffer)
+        self.source.start()
+        self.buffering = True
+        self.stream_started = False
+        self.stream_error = None
+        self.track = self.upcoming = self.tail = None
+        self.name = self.source.name
+        self.length = math.inf
+        self.playing = True
+        self.youtube_id = None
+        self.gain = 1.0
+        self.apply_volume()
+        self.sync_share()
+        now = time.monotonic()
+        self.next_render = now if self.renderer is not None else math.inf
+        self.next_presence = now + PRESENCE_REFRESH_INTERVAL
+        try:
+            self.loop()
+        finally:
+            self.source.close()
+            self.source = None
+            self.buffering = False
+
+    def loop(self) -> None:
+        self.wakeups, self.wakeup_window = 0, time.monotonic()
+        # instead of polling every 10ms, sleep until there is input, the next render
+        # tick, the next transition or the estimated end of the track
+        while mixer.music.get_busy() or not self.playing or self.buffering:
+            keys = self.input.wait(self.timeout())
+            started = time.perf_counter()
+            skip = self.tick(keys, self.input.woken)
+            METRICS.record("loop", time.perf_counter() - started)
+            METRICS.sample_threads()
+            if skip:
+                break
+        if self.renderer is not None:
+            self.renderer.finish()
+
+    def begin(self, track: "Track") -> None:
+        # switches everything shown over to the track that just started
+        self.track = track
+        self.name = name = track.display_name
+        # 0 when it couldn't be probed, which is handled as an unknown length
+        self.length = track.length or 0.0
+        self.playing = True
+        self.youtube_id = track.youtube_id
+        self.upcoming = None
+        self.tail = None
+        if self.history is not None:
+            self.history.record(track.id, PlayHistory.PLAY)
+        if self.normalize_loudness:
+            # measured while it was queued, possibly
+            current = self.library.tracks.get(track.path, track)
+            self.gain = LoudnessAnalyzer.linear(current.gain)
+            self.apply_volume()
+        self.update(name=name, start=self.get_start(), end=self.get_end())
+        self.sync_share()
+        now = time.monotonic()
+        self.next_render = now if self.renderer is not None else math.inf
+        self.next_presence = now + PRESENCE_REFRESH_INTERVAL
+        if self.crossfade > 0 and self.length > 0:
+            threading.Thread(
+                target=self.decode_tail, args=(track,), daemon=True
+            ).start()
+
+    def decode_tail(self, track: "Track") -> None:
+        # decodes the end of the track for the crossfade into the next one. pygame
+        # can only decode whole files, so tracks whose decoded size (twice over, for
+        # the copy) would exceed the budget are played gaplessly instead
+        frequency, size, channels = mixer.get_init()
+        frame = abs(size) // 8 * channels
+        if track.length * frequency * frame * 2 > self.preload_budget:
+            return
+        try:
+            raw = mixer.Sound(track.path).get_raw()
+        except Exception:
+            return
+        start = max(len(raw) - int((self.crossfade + 1) * frequency) * frame, 0)
+        # the decoded length is exact, unlike the probed one
+        if self.track is track:
+            self.tail = (track.path, start / (frequency * frame), raw[start:])
+
+    def preload(self) -> None:
+        song, source = self.next_song()
+        track = self.library.get(song)
+        if track is None:
+            return
+        mixer.music.queue(track.path)
+        self.upcoming, self.upcoming_from = track, source
+        if self.metadata_cache is not None and track.youtube_id is not None:
+            self.worker.submit("metadata-prefetch", self.prefetch_metadata, track)
+
+    def prefetch_metadata(self, track: "Track") -> None:
+        # warms the metadata cache, so the presence update at the boundary is instant
+        with contextlib.suppress(Exception):
+            self.metadata_cache.lookup(track.youtube_id, self.worker.session)
+
+    def start_crossfade(self, position: float) -> None:
+        _, tail_start, tail = self.tail
+        frequency, size, channels = mixer.get_init()
+        frame = abs(size) // 8 * channels
+        skip = max(int((position - tail_start) * frequency), 0) * frame
+        sound = mixer.Sound(buffer=tail[skip:])
+        self.tail = None
+        self.tail_gain = self.gain
+        self.tail_channel = sound.play(fade_ms=0)
+        if self.tail_channel is not None:
+            self.tail_channel.set_volume(self.volume * self.tail_gain)
+            sound.fadeout(int(self.crossfade * 1000))
+        mixer.music.load(self.upcoming.path)
+        mixer.music.play(fade_ms=int(self.crossfade * 1000))
+        self.pos_offset = self.last_raw = 0.0
+
+    def transition(self) -> None:
+        # preloads the next track, and notices when the mixer moved on to it
+        if self.source is not None:
+            return self.transition_stream()
+        raw = max(mixer.music.get_pos(), 0) / 1000
+        if raw < self.last_raw - 0.5:
+            # the mixer restarted its clock for the queued track. if the boundary was
+            # already crossed by length below, only the offset is out of date
+            self.last_raw = raw
+            crossed = self.pos_offset > 0
+            self.pos_offset = 0.0
+            if not crossed and self.upcoming is not None:
+                self.advance()
+            return
+        self.last_raw = raw
+        if self.length <= 0:
+            # the length couldn't be probed, so the boundary can't be told from the
+            # clock. nothing is preloaded and the play loop ends with get_busy
+            return
+        position = raw - self.pos_offset
+        if self.upcoming is None:
+            if position >= self.length - self.PRELOAD_AHEAD - self.crossfade:
+                self.preload()
+            return
+        if self.crossfade_ready() and position >= self.length - self.crossfade:
+            self.start_crossfade(position)
+            self.advance()
+        elif position >= self.length:
+            self.pos_offset += self.length
+            self.advance()
+
+    def transition_stream(self) -> None:
+        # starts the stream once the prefetch is buffered, and pauses it while the
+        # buffer runs dry instead of letting the decoder block on it
+        buffer = self.source.buffer
+        if self.buffering:
+            if buffer.size < self.stream_prefetch and not buffer.eof:
+                return
+            self.buffering = False
+            if buffer.written == 0:
+                # nothing ever arrived, the loop ends with the stream
+                return
+            if not self.stream_started:
+                self.stream_started = True
+                self.name = self.source.name
+                try:
+                    mixer.music.load(buffer, self.source.format)
+                except Exception as e:
+                    # not something the mixer can decode, the loop ends with the stream
+                    self.stream_error = str(e)
+                    self.source.close()
+                    return
+                mixer.music.play()
+                if not self.playing:
+                    mixer.music.pause()
+                TIMINGS.mark("first audio")
+                self.update(name=self.name, start=time.time())
+                if self.renderer is not None:
+                    self.next_render = time.monotonic()
+            elif self.playing:
+                mixer.music.unpause()
+        elif buffer.size < StreamSource.LOW_WATER and not buffer.eof and self.playing:
+            mixer.music.pause()
+            self.buffering = True
+            self.underruns += 1
+
+    def crossfade_ready(self) -> bool:
+        return self.tail is not None and self.tail[0] == self.track.path
+
+    def advance(self) -> None:
+        if self.renderer is not None:
+            self.renderer.finish()
+        self.begin(self.upcoming)
+
+    def timeout(self) -> "float | None":
+        now = time.monotonic()
+        if self.source is not None:
+            # the buffer fills and drains on its own, so it's checked regularly
+            return max(min(self.next_render, now + 0.25) - now, 0)
+        if not self.playing:
+            # nothing moves while paused, so only input can change the screen
+            return None
+        if self.length <= 0:
+            # an unknown length, so the end is noticed by checking get_busy
+            return max(
+                min(
+                    self.next_render,
+                    self.next_presence,
+                    self.next_share,
+                    self.next_metrics,
+                    now + self.UNKNOWN_LENGTH_POLL,
+                )
+                - now,
+                0,
             )
+        # wakes up for the preload, the start of a crossfade and the end of the track
+        remaining = self.length - self.position()
+        if self.upcoming is None:
+            remaining -= self.PRELOAD_AHEAD + self.crossfade
+        elif self.crossfade_ready():
+            remaining -= self.crossfade
+        # past the probed length, fall back to checking get_busy periodically
+        return max(
+            min(
+                self.next_render,
+                self.next_presence,
+                self.next_share,
+                self.next_metrics,
+                now + (remaining if remaining > 0.01 else 0.1),
+            )
+            - now,
+            0,
         )
 
-    def ceil(self, val: int):
-        return math.ceil(val) if val > 0 else 1
+    def tick(self, keys: str, woken: bool = False) -> bool:
+        # one wakeup of the play loop. returns True when the song should be skipped
+        now = time.monotonic()
+        self.wakeups += 1
+        if now - self.wakeup_window >= 1:
+            self.wakeup_rate = self.wakeups / (now - self.wakeup_window)
+            self.wakeups, self.wakeup_window = 0, now
+        for c in keys:
+            if self.handle_key(c):
+                return True
+        self.transition()
+        if self.control is not None:
+            for request, future in self.control.pending():
+                try:
+                    response, skip = self.handle_command(request)
+                except Exception as e:
+                    # a bad request shouldn't take the player down with it
+                    response, skip = {
+                        "ok": False,
+                        "error": f"{type(e).__name__}: {e}",
+                    }, False
+                future.set_result(response)
+                if skip:
+                    return True
+        if self.playing and now >= self.next_presence:
+            self.update(name=self.name, start=self.get_start(), end=self.get_end())
+            self.next_presence = now + PRESENCE_REFRESH_INTERVAL
+        if self.playing and now >= self.next_share:
+            self.sync_share()
+        if now >= self.next_metrics:
+            self.metrics_file.write(json.dumps(METRICS.snapshot()) + "\n")
+            self.metrics_file.flush()
+            self.next_metrics = now + self.metrics_interval
+        if self.renderer is not None and (keys or woken or now >= self.next_render):
+            started = time.perf_counter()
+            self.render()
+            METRICS.record("render", time.perf_counter() - started)
+            # line the ticks up with the second boundaries of the timers
+            render_interval = 1 / self.fps
+            elapsed = self.position()
+            self.next_render = now + render_interval - (elapsed % render_interval)
+        return False
 
 
 if __name__ == "__main__":
+    cache_names = [*BoundedCache.instances, MetadataCache.MEMORY_CACHE]
+
+    def cache_limit(text: str) -> "tuple[str, float]":
+        name, _, value = text.partition("=")
+        if name not in cache_names:
+            raise argparse.ArgumentTypeError(
+                f"unknown cache {name!r}, expected one of {', '.join(cache_names)}"
+            )
+        return name, float(value)
+
     parser = argparse.ArgumentParser(
         prog="Inflo",
         description="A lightweight music player",
@@ -501,27 +3510,220 @@ if __name__ == "__main__":
     parser.add_argument("--disable-discord", action="store_true")
     parser.add_argument("--disable-api", action="store_true")
     parser.add_argument("--enable-share", action="store_true")
+    parser.add_argument("--share-url", default=INFLO_SHARE_URL)
+    parser.add_argument("--index", default=LIBRARY_INDEX_FILE)
+    parser.add_argument(
+        "--library",
+        action="append",
+        help="a directory to scan recursively for music, can be given more than once (default: .)",
+    )
+    parser.add_argument("--scan-workers", type=int, default=8)
+    parser.add_argument(
+        "--normalize-loudness",
+        action="store_true",
+        help="measure tracks with ffmpeg in the background and play them at --loudness-target",
+    )
+    parser.add_argument("--loudness-target", type=float, default=-18)
+    parser.add_argument("--loudness-workers", type=int, default=2)
+    parser.add_argument(
+        "--schedule",
+        help="a file with one track per line to play in order before sampling, see generate_weights.py --schedule",
+    )
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument(
+        "--disable-history",
+        action="store_true",
+        help="don't remember plays and skips or use them to pick tracks",
+    )
+    parser.add_argument(
+        "--recency-window",
+        type=float,
+        default=60,
+        help="minutes after a play during which a track is less likely to be picked again",
+    )
+    parser.add_argument(
+        "--skip-half-life",
+        type=float,
+        default=30,
+        help="days after which a skip counts half as much against a track",
+    )
+    parser.add_argument("--fps", type=float, default=1)
+    parser.add_argument(
+        "--crossfade",
+        type=float,
+        default=0,
+        help="seconds to overlap tracks by, 0 plays them back to back without a gap",
+    )
+    parser.add_argument(
+        "--preload-budget",
+        type=float,
+        default=128,
+        help="megabytes a track may take decoded, to be crossfaded out of",
+    )
+    parser.add_argument(
+        "--stream",
+        help="an http(s) url or a file that is still being written to, played before the library",
+    )
+    parser.add_argument(
+        "--stream-buffer", type=int, default=1024, help="ring buffer size in KB"
+    )
+    parser.add_argument(
+        "--stream-prefetch",
+        type=int,
+        default=64,
+        help="KB buffered before the stream starts or resumes after running dry",
+    )
+    parser.add_argument("--report-wakeups", action="store_true")
+    parser.add_argument("--presence-stats", action="store_true")
+    parser.add_argument("--api-url", default=INFLO_API_URL)
+    parser.add_argument("--metadata-cache", default=METADATA_CACHE_FILE)
+    parser.add_argument("--metadata-ttl", type=float, default=7 * 24 * 3600)
+    parser.add_argument("--metadata-max-entries", type=int, default=50000)
+    parser.add_argument("--warm-metadata", action="store_true")
+    parser.add_argument(
+        "--cache-entries",
+        type=cache_limit,
+        action="append",
+        metavar="NAME=COUNT",
+        help=f"entry limit of an in-memory cache, one of {', '.join(cache_names)}",
+    )
+    parser.add_argument(
+        "--cache-bytes",
+        type=cache_limit,
+        action="append",
+        metavar="NAME=KB",
+        help="memory budget of an in-memory cache",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=cache_limit,
+        action="append",
+        metavar="NAME=SECONDS",
+        help="how long entries of an in-memory cache are kept",
+    )
+    parser.add_argument("--warm-parallelism", type=int, default=8)
+    parser.add_argument("--timings", action="store_true")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="run headless, controlled through --control-socket (see inflo_ctl.py)",
+    )
+    parser.add_argument("--control-socket", default=CONTROL_SOCKET_FILE)
+    parser.add_argument(
+        "--metrics-log", help="append a json line of runtime metrics to this file"
+    )
+    parser.add_argument("--metrics-interval", type=float, default=10)
+    parser.add_argument(
+        "--profile",
+        help="write cProfile stats of the main thread to this file on exit",
+    )
 
     args = parser.parse_args()
+    limits: "dict[str, dict[str, float]]" = {}
+    for setting, values, scale in (
+        ("max_entries", args.cache_entries, 1),
+        ("max_bytes", args.cache_bytes, 1024),
+        ("ttl", args.cache_ttl, None),
+    ):
+        for name, value in values or []:
+            limits.setdefault(name, {})[setting] = (
+                value if scale is None else int(value * scale)
+            )
+    BoundedCache.configure_all(limits)
+    if args.daemon and not hasattr(socket, "AF_UNIX"):
+        parser.error("--daemon needs unix domain sockets")
+    TIMINGS.mark("arguments parsed")
+    if args.profile:
+        import cProfile
 
-    pres = None
-    if not args.disable_discord:
-        try:
-            pres = pypresence.Presence("1033827079994753064")
-            pres.connect()
-        except Exception as e:
-            print("No pres: " + str(e))
-            pres = None
+        profiler = cProfile.Profile()
+        # registered in this order so profiling stops before the stats are written
+        atexit.register(profiler.dump_stats, args.profile)
+        atexit.register(profiler.disable)
+        profiler.enable()
+    if args.timings:
+        # registered first so it runs last, after the terminal has been restored
+        atexit.register(lambda: print(TIMINGS.report(), file=sys.stderr))
+
+    library = LibraryIndex(args.index, args.library, args.scan_workers)
+    atexit.register(library.close)
+    # the scan streams into the index in the background, playback starts as soon
+    # as there is something to play
+    library.start_scan(force=True)
+    library.ready.wait()
+    TIMINGS.mark("library ready")
+
+    if args.normalize_loudness:
+        analyzer = LoudnessAnalyzer(
+            library, args.loudness_workers, args.loudness_target
+        )
+        if analyzer.start():
+            atexit.register(analyzer.close)
+
+    metadata_cache = None
+    if not args.disable_api:
+        metadata_cache = MetadataCache(
+            args.metadata_cache,
+            api_url=args.api_url,
+            ttl=args.metadata_ttl,
+            max_entries=args.metadata_max_entries,
+        )
+        atexit.register(metadata_cache.close)
+        if args.warm_metadata:
+            metadata_cache.warm(
+                [
+                    track.youtube_id
+                    for track in library.tracks.values()
+                    if track.youtube_id is not None
+                ],
+                args.warm_parallelism,
+            )
+
+    history = None
+    if not args.disable_history:
+        history = PlayHistory(
+            args.history,
+            library,
+            recency_window=args.recency_window * 60,
+            skip_half_life=max(args.skip_half_life, 1e-3) * 24 * 3600,
+        )
+        atexit.register(history.close)
+
+    schedule = None
+    if args.schedule:
+        with open(args.schedule, encoding="utf8") as file:
+            schedule = [
+                line.strip()
+                for line in file
+                if line.strip() and not line.startswith("#")
+            ]
 
-    print("\n\x1b[?25l")
-    atexit.register(print, "\x1b[?25h", end="")
+    if not args.daemon:
+        print("\n\x1b[?25l")
+        atexit.register(print, "\x1b[?25h", end="")
 
     player = MusicPlayer(
-        pres,
+        not args.disable_discord,
         args.first_song,
         weights_file=args.weights,
-        disable_api=args.disable_api,
+        metadata_cache=metadata_cache,
         enable_share=args.enable_share,
+        library=library,
+        share_url=args.share_url,
+        fps=args.fps,
+        report_wakeups=args.report_wakeups,
+        presence_stats=args.presence_stats,
+        control_socket=args.control_socket if args.daemon else None,
+        metrics_log=args.metrics_log,
+        metrics_interval=args.metrics_interval,
+        crossfade=max(args.crossfade, 0),
+        preload_budget=int(args.preload_budget * 1024 * 1024),
+        normalize_loudness=args.normalize_loudness,
+        stream=args.stream,
+        stream_buffer=args.stream_buffer * 1024,
+        stream_prefetch=args.stream_prefetch * 1024,
+        schedule=schedule,
+        history=history,
     )
     try:
         player.start()
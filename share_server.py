@@ -0,0 +1,137 @@
+import argparse, json, random, secrets, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+parser = argparse.ArgumentParser(
+    prog=sys.argv[0],
+    description="A local stand-in for the Inflo share server, for testing --enable-share offline",
+)
+
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8787)
+parser.add_argument("--latency", type=float, default=0, help="seconds per request")
+parser.add_argument(
+    "--fail-rate", type=float, default=0, help="fraction of requests answered with 503"
+)
+parser.add_argument(
+    "--expire",
+    type=float,
+    default=0,
+    help="forget shares after this many seconds without updates, 0 to keep them",
+)
+parser.add_argument("--quiet", action="store_true")
+args = parser.parse_args()
+
+lock = threading.Lock()
+shares: "dict[str, dict]" = {}
+owners: "dict[str, str]" = {}
+counts = {"start": 0, "update": 0, "rejected": 0, "failed": 0, "view": 0}
+
+
+def expire() -> None:
+    if args.expire <= 0:
+        return
+    now = time.monotonic()
+    for secret, share_id in list(owners.items()):
+        if now - shares[share_id]["updated"] > args.expire:
+            del owners[secret], shares[share_id]
+
+
+def view(share: dict) -> dict:
+    # the progress moves along with the clock while playing, like a listener sees it
+    elapsed = time.monotonic() - share["updated"] if share["playing"] else 0
+    return {
+        "id": share["id"],
+        "playing": share["playing"],
+        "progress": share["progress"] + elapsed,
+        "updates": share["updates"],
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    def reply(self, status: int, body: "dict | None" = None) -> None:
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def simulate(self) -> bool:
+        # returns False when this request should fail
+        if args.latency > 0:
+            time.sleep(args.latency)
+        if random.random() < args.fail_rate:
+            with lock:
+                counts["failed"] += 1
+            self.reply(503)
+            return False
+        return True
+
+    def do_POST(self):
+        if self.path != "/start":
+            return self.reply(404)
+        if not self.simulate():
+            return
+        with lock:
+            expire()
+            share_id, secret = secrets.token_urlsafe(6), secrets.token_urlsafe(16)
+            shares[share_id] = {
+                "id": None,
+                "playing": False,
+                "progress": 0.0,
+                "updated": time.monotonic(),
+                "updates": 0,
+            }
+            owners[secret] = share_id
+            counts["start"] += 1
+        self.reply(200, {"id": share_id, "secret": secret})
+
+    def do_PUT(self):
+        if not self.path.startswith("/update/"):
+            return self.reply(404)
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"] or 0)))
+        if not self.simulate():
+            return
+        with lock:
+            expire()
+            share_id = owners.get(self.path[len("/update/") :])
+            if share_id is None:
+                counts["rejected"] += 1
+                return self.reply(200, {"status": "fail"})
+            share = shares[share_id]
+            share.update(
+                id=body.get("id"),
+                playing=bool(body.get("playing")),
+                progress=float(body.get("progress", 0)),
+                updated=time.monotonic(),
+                updates=share["updates"] + 1,
+            )
+            counts["update"] += 1
+        self.reply(200, {"status": "ok"})
+
+    def do_GET(self):
+        with lock:
+            if self.path == "/stats":
+                return self.reply(200, {**counts, "shares": len(shares)})
+            share = shares.get(self.path.lstrip("/"))
+            counts["view"] += 1
+            if share is None:
+                return self.reply(404)
+            self.reply(200, view(share))
+
+    def log_message(self, format, *log_args):
+        if not args.quiet:
+            super().log_message(format, *log_args)
+
+
+server = ThreadingHTTPServer((args.host, args.port), Handler)
+print(
+    f"share server on http://{args.host}:{args.port}/, run the player with --enable-share --share-url http://{args.host}:{args.port}/",
+    file=sys.stderr,
+)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    print(json.dumps({**counts, "shares": len(shares)}), file=sys.stderr)
@@ -0,0 +1,99 @@
+import argparse, os, sys, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+parser = argparse.ArgumentParser(
+    prog=sys.argv[0],
+    description="Serves an audio file as a throttled internet radio stream, for testing --stream offline",
+)
+
+parser.add_argument("file")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8788)
+parser.add_argument("--bitrate", type=int, default=128, help="kbit/s to send at")
+parser.add_argument("--loop", action="store_true", help="repeat the file forever")
+parser.add_argument(
+    "--stall-every",
+    type=float,
+    default=0,
+    help="stop sending for --stall-for seconds this often, 0 to never stall",
+)
+parser.add_argument("--stall-for", type=float, default=3)
+parser.add_argument(
+    "--drop-after",
+    type=int,
+    default=0,
+    help="close the connection after this many KB, 0 to never drop it",
+)
+parser.add_argument("--name", help="sent as icy-name, the name the player shows")
+parser.add_argument("--quiet", action="store_true")
+args = parser.parse_args()
+
+CHUNK = 4096
+CONTENT_TYPES = {
+    ".mp3": "audio/mpeg",
+    ".ogg": "audio/ogg",
+    ".flac": "audio/flac",
+    ".wav": "audio/wav",
+}
+
+with open(args.file, "rb") as file:
+    data = file.read()
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        offset = 0
+        ranged = self.headers.get("Range", "")
+        if not args.loop and ranged.startswith("bytes="):
+            offset = min(int(ranged[len("bytes=") :].split("-")[0] or 0), len(data))
+        # no content length, like a live stream
+        self.send_response(206 if offset else 200)
+        self.send_header(
+            "Content-Type",
+            CONTENT_TYPES.get(os.path.splitext(args.file)[1].lower(), "audio/mpeg"),
+        )
+        if not args.loop:
+            self.send_header("Accept-Ranges", "bytes")
+        if args.name:
+            self.send_header("icy-name", args.name)
+        self.end_headers()
+
+        rate = args.bitrate * 1000 / 8
+        started = time.monotonic()
+        next_stall = started + args.stall_every if args.stall_every > 0 else None
+        stalled = 0.0
+        sent = 0
+        try:
+            while offset < len(data) or args.loop:
+                if args.loop and offset >= len(data):
+                    offset = 0
+                chunk = data[offset : offset + CHUNK]
+                self.wfile.write(chunk)
+                offset += len(chunk)
+                sent += len(chunk)
+                if args.drop_after and sent >= args.drop_after * 1024:
+                    return
+                now = time.monotonic()
+                if next_stall is not None and now >= next_stall:
+                    time.sleep(args.stall_for)
+                    stalled += args.stall_for
+                    next_stall = time.monotonic() + args.stall_every
+                # sleeps until this many bytes are due at the bitrate
+                time.sleep(max(started + stalled + sent / rate - time.monotonic(), 0))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *log_args):
+        if not args.quiet:
+            super().log_message(format, *log_args)
+
+
+server = ThreadingHTTPServer((args.host, args.port), Handler)
+print(
+    f"streaming {args.file} on http://{args.host}:{args.port}/, run the player with --stream http://{args.host}:{args.port}/",
+    file=sys.stderr,
+)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass